@@ -1,9 +1,5 @@
 import argparse
-import met2verif.util
 import met2verif.version
-import netCDF4
-import numpy as np
-import os
 import sys
 
 
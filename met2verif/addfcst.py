@@ -1,14 +1,18 @@
 import argparse
+import collections
+import concurrent.futures
 import copy
 import netCDF4
 import numpy as np
 import os
+import queue
 import sys
+import threading
 import time
 import traceback
 import met2verif.fcstinput
-import met2verif.locinput
-import met2verif.obsinput
+import met2verif.ledger
+import met2verif.timerows
 import met2verif.util
 import met2verif.version
 
@@ -25,17 +29,24 @@ def add_subparser(parser):
     subparser.add_argument('-f', help='Overwrite values if they are there already', dest="overwrite", action="store_true")
     subparser.add_argument('-s', help='Sort times if needed?', dest="sort", action="store_true")
     subparser.add_argument('-n', default=0, type=int, help='Neighbourhood radius', dest="hood")
+    subparser.add_argument('--interp', default="nearest", help='Interpolation from the grid to the locations (idw: inverse distance weighting). Cannot be combined with -n.', dest="interpolation", choices=["nearest", "bilinear", "idw"])
     subparser.add_argument('-v', type=str, help='Variable name in forecast files', dest="variable", required=True)
     subparser.add_argument('-vo', default="fcst", type=str, help='Variable name in verif file', dest="ovariable")
     subparser.add_argument('-w', default=1, type=int, help='Time aggregation window in number of timesteps of input file', dest="time_window")
     subparser.add_argument('-to', type=float, help='Output threshold or quantile', dest="othreshold")
-    subparser.add_argument('--windspeed', help='Compute wind speed?', action="store_true")
+    subparser.add_argument('--windspeed', help='Compute wind speed from x and y wind components (-v x_variable_name,y_variable_name)?', action="store_true")
+    subparser.add_argument('--winddir', help='Compute wind direction (degrees, relative to the grid) from x and y wind components (-v x_variable_name,y_variable_name)? Members, neighbourhoods, and time windows are aggregated by using the direction of the summed components.', action="store_true")
+    subparser.add_argument('--dewpoint', help='Compute dew point temperature (K) from temperature (K) and relative humidity (1) (-v temperature_variable_name,rh_variable_name)?', action="store_true")
     subparser.add_argument('--add', type=float, default=0, help='Add this value to all forecasts (--multiply is done before --add)')
     subparser.add_argument('--multiply', type=float, default=1, help='Multiply all forecasts with this value')
     subparser.add_argument('--debug', help='Display debug information', action="store_true")
     subparser.add_argument('--deacc', help='Deaccumulate values in time', action="store_true")
     subparser.add_argument('-ft', help='Fill in time', dest="fill_time", action="store_true")
     subparser.add_argument('--sync', metavar="FREQ", type=int, help='How often to Sync?', dest="sync_frequency")
+    subparser.add_argument('-j', default=1, type=int, help='Number of processes to read forecast files with', dest="num_processes")
+    subparser.add_argument('--prefetch', metavar="N", default=0, type=int, help='Read up to N forecast files ahead in a background thread, while earlier files are processed. Ignored when -j is more than 1.')
+    subparser.add_argument('--ledger', metavar="FILE", help='Record added files in this SQLite file, and skip files that have been added before with the same options and have not changed since. Ignored for -f.')
+    subparser.add_argument('--cache', metavar="DIR", help='Cache nearest neighbour lookups in this directory, for reuse in later runs', dest="cache_dir")
 
     return subparser
 
@@ -43,10 +54,16 @@ def add_subparser(parser):
 def run(parser, argv=sys.argv[1:]):
     args = parser.parse_args(argv)
     aggregator = get_aggregator(args.aggregator)
+    get_derived_quantity(args)
+    if args.winddir and args.aggregator != "mean":
+        met2verif.util.error("--winddir can only be used with -a mean, since directions are aggregated by averaging the wind components")
+    if args.interpolation != "nearest" and args.hood > 0:
+        met2verif.util.error("--interp cannot be combined with -n")
 
     if not os.path.exists(args.verif_file):
         met2verif.util.error("File '%s' does not exist" % args.verif_file)
 
+    stamp = met2verif.timerows.get_stamp(args.verif_file)
     file = netCDF4.Dataset(args.verif_file, 'a')
     times = file.variables["time"]
     if len(times) == 0:
@@ -59,13 +76,27 @@ def run(parser, argv=sys.argv[1:]):
     ids_orig = np.array(file.variables["location"][:])
     leadtimes_orig = np.array(file.variables["leadtime"][:])
 
+    """
+    Skip files that have already been added, without opening them
+    """
+    filenames = args.files
+    ledger = None
+    if args.ledger is not None:
+        ledger = met2verif.ledger.Ledger(args.ledger, args.verif_file, args.ovariable, met2verif.ledger.get_options_hash(args))
+        if args.clear:
+            ledger.clear()
+        elif not args.overwrite:
+            filenames = [filename for filename in filenames if not ledger.has(filename)]
+            if args.debug:
+                print("Skipping %d files that have already been added" % (len(args.files) - len(filenames)))
+
     """
     Read inputs
     """
     inputs = list()
-    for filename in args.files:
+    for filename in filenames:
         try:
-            inputs += [met2verif.fcstinput.get(filename)]
+            inputs += [met2verif.fcstinput.get(filename, args.cache_dir)]
         except Exception as e:
             print("Could not open file '%s'. %s." % (filename, e))
             if args.debug:
@@ -93,13 +124,15 @@ def run(parser, argv=sys.argv[1:]):
     thresholds_orig = list()
     quantiles_orig = list()
     if "threshold" in file.variables:
-        thresholds_orig = file.variables["threshold"]
+        thresholds_orig = file.variables["threshold"][:]
     if "quantile" in file.variables:
-        quantiles_orig = file.variables["quantile"]
+        quantiles_orig = file.variables["quantile"][:]
     num_members = 0
     if "ensemble" in file.variables:
         ensemble_orig = file.variables["ensemble"]
         num_members = ensemble_orig.shape[3]
+    if args.winddir and (len(thresholds_orig) > 0 or len(quantiles_orig) > 0):
+        met2verif.util.error("--winddir cannot be used with verif files that have thresholds or quantiles")
 
     num_dims = len(file.variables[args.ovariable].shape)
     is_threshold_field = num_dims == 4
@@ -118,34 +151,52 @@ def run(parser, argv=sys.argv[1:]):
         else:
             met2verif.util.error("Variable '%s' has 4 dimensions. You need to specify threshold '-to'." % (num_dims))
 
-    fcst = np.nan * np.zeros([len(times_new), len(leadtimes_orig), len(ids_orig)])
-    tfcst = np.nan * np.zeros([len(times_new), len(leadtimes_orig), len(ids_orig), len(thresholds_orig)])
-    qfcst = np.nan * np.zeros([len(times_new), len(leadtimes_orig), len(ids_orig), len(quantiles_orig)])
-    efcst = np.nan * np.zeros([len(times_new), len(leadtimes_orig), len(ids_orig), num_members])
-    pit = np.nan * np.zeros([len(times_new), len(leadtimes_orig), len(ids_orig)])
-    if len(times_orig) > 0 and not args.clear:
-        if is_threshold_field:
-            fcst[range(len(times_orig)), :, :] = file.variables[args.ovariable][:, :, :, Ithreshold]
-        else:
-            fcst[range(len(times_orig)), :, :] = file.variables[args.ovariable][:]
-        # Convert fill values to nan
-        fcst[fcst == netCDF4.default_fillvals['f4']] = np.nan
-
-        if len(thresholds_orig) > 0:
-            tfcst[range(len(times_orig)), :, :, :] = file.variables['cdf'][:]
-            tfcst[tfcst == netCDF4.default_fillvals['f4']] = np.nan
-        if len(quantiles_orig) > 0:
-            qfcst[range(len(times_orig)), :, :, :] = file.variables['x'][:]
-            qfcst[qfcst == netCDF4.default_fillvals['f4']] = np.nan
-        if num_members > 0:
-            efcst[range(len(times_orig)), :, :, :] = file.variables['ensemble'][:]
-            efcst[efcst == netCDF4.default_fillvals['f4']] = np.nan
-
-    file.variables["time"][:] = times_new
+    """
+    Forecasts already in the file are read, and new forecasts written, only for the times
+    that the input files are placed in
+    """
+    """
+    New times are always added after the existing times, such that only the new part of the
+    time dimension needs to be written, and existing records are left untouched.
+    """
+    if len(times_add) > 0:
+        file.variables["time"][len(times_orig):] = times_add
+    if is_threshold_field:
+        fcst = met2verif.timerows.TimeRows(file.variables[args.ovariable], Ithreshold, clear=args.clear, num_existing=len(times_orig), coverage=True, stamp=stamp)
+    else:
+        fcst = met2verif.timerows.TimeRows(file.variables[args.ovariable], clear=args.clear, num_existing=len(times_orig), coverage=True, stamp=stamp)
+    outputs = list()
+    if len(thresholds_orig) > 0:
+        tfcst = met2verif.timerows.TimeRows(file.variables['cdf'], clear=args.clear, num_existing=len(times_orig))
+        outputs += [tfcst]
+    if len(quantiles_orig) > 0:
+        qfcst = met2verif.timerows.TimeRows(file.variables['x'], clear=args.clear, num_existing=len(times_orig))
+        outputs += [qfcst]
+    if num_members > 0:
+        efcst = met2verif.timerows.TimeRows(file.variables['ensemble'], clear=args.clear, num_existing=len(times_orig))
+        outputs += [efcst]
+    # Write the output variable last, since it can be one of the variables above
+    outputs += [fcst]
+    if args.clear:
+        for output in outputs:
+            output.clear(len(times_orig))
+
     lats_orig = file.variables["lat"][:]
     lons_orig = file.variables["lon"][:]
 
-    for Iinput, input in enumerate(inputs):
+    """
+    Read and process each input file. This can happen in parallel, but the results are
+    placed into the output arrays in the order of the input files, such that the output
+    is the same as when the files are processed one after another.
+    """
+    tasks = get_tasks(inputs, args, fcst, leadtimes_orig, times_new)
+    lock = threading.Lock()
+    if args.num_processes <= 1 and args.prefetch > 0:
+        results = prefetch_tasks(tasks, args.prefetch, lock, args, lats_orig, lons_orig, thresholds_orig, quantiles_orig)
+    else:
+        results = map_tasks(tasks, args.num_processes, args, lats_orig, lons_orig, thresholds_orig, quantiles_orig)
+    ingested = list()
+    for Iinput, input, task, result, error in results:
         time_s = time.time()
         print("Processing %s" % input.filename)
         if args.debug:
@@ -153,109 +204,433 @@ def run(parser, argv=sys.argv[1:]):
             frac = float(Iinput) / len(inputs)
             #if Iinput % step == 0:
             #                met2verif.util.progress_bar(frac, 80)
-        try:
-            Itime, Ilt_input, Ilt_output = get_time_indices(input.leadtimes, input.forecast_reference_time, leadtimes_orig, times_new, args.delays, args.fill_time)
-            #print(Itime, Ilt_input, Ilt_output)
-
-            """
-            Determine if we need to write data from this filename. This is only
-            when the data we are writing to is missing.
-            """
-            do_write = args.overwrite
-            for i in range(len(Itime)):
-                if np.sum(np.isnan(fcst[Itime[i], Ilt_output[i], :]) == 0) == 0:
-                    do_write = True
-                break
-
-            if not do_write:
-                if args.debug:
-                    print("We do not need to read this file")
-                continue
-
-            if args.windspeed:
-                """ Diagnose winds from x and y """
-                variables = args.variable.split(',')
-                if len(variables) != 2:
-                    met2verif.util.error("-v must be x_variable_name,y_variable_name")
-                xvariable = variables[0]
-                yvariable = variables[1]
-                curr_x = input.extract(lats_orig, lons_orig, xvariable, args.members, args.hood)
-                curr_y = input.extract(lats_orig, lons_orig, yvariable, args.members, args.hood)
-                curr_fcst = np.sqrt(curr_x ** 2 + curr_y ** 2)
-            else:
-                curr_fcst = input.extract(lats_orig, lons_orig, args.variable, args.members, args.hood)
-
-            if args.deacc:
-                assert(args.time_window > 0)
-                curr_fcst[args.time_window:, ...] = curr_fcst[args.time_window:, ...] - curr_fcst[0:-args.time_window, ...]
-                curr_fcst[0:args.time_window, ...] = np.nan
-            else:
-                if args.time_window == 1:
-                    pass
-                    # Faster, potentially. Though should give the same results as code below
-                else:
-                    curr_fcst = np.cumsum(curr_fcst, axis=0)
-                    curr_fcst[args.time_window:, ...] = curr_fcst[args.time_window:, ...] - curr_fcst[0:-args.time_window, ...]
-                    curr_fcst[0:args.time_window, ...] = np.nan
+        if error is not None:
+            print("Could not process: %s" % error)
+            if args.debug:
+                traceback.print_exception(type(error), error, error.__traceback__)
+            continue
 
-            curr_fcst = curr_fcst * args.multiply + args.add
+        Itime, Ilt_input, Ilt_output = task
+        if not args.overwrite and not is_missing(fcst, Itime, Ilt_output):
+            # An earlier file has filled in the data while this file was processed
+            if args.debug:
+                print("We do not need to read this file")
+            continue
 
-            """ Now figure out where to put this data """
+        """ Now figure out where to put this data """
+        # The netCDF library is not thread-safe, so don't use the file while files are read
+        with lock:
             for i in range(len(Itime)):
                 curr_Itime = Itime[i]
                 curr_Ilt_output = Ilt_output[i]
                 curr_Ilt_input = Ilt_input[i]
                 print(curr_Itime, curr_Ilt_output, curr_Ilt_input)
-                curr_fcst0 = curr_fcst[curr_Ilt_input, :, :]
-                fcst[curr_Itime, curr_Ilt_output, :] = aggregator(curr_fcst0, axis=2)
-                for i in range(len(thresholds_orig)):
-                    # The inequality operator does not respect nans (returns 0 instead)
-                    temp = np.zeros(curr_fcst0.shape, float)
-                    temp[:] = curr_fcst0 < thresholds_orig[i]
-                    temp[np.isnan(curr_fcst0)] = np.nan
-                    tfcst[curr_Itime, curr_Ilt_output, :, i] = np.nanmean(temp, axis=2)
-                for i in range(len(quantiles_orig)):
-                    # Avoid using nanpercentile, if possible, since it is much slower
-                    num_missing = np.sum(np.isnan(curr_fcst0))
-                    if num_missing == 0:
-                        qfcst[curr_Itime, curr_Ilt_output, :, i] = np.percentile(curr_fcst0, quantiles_orig[i] * 100, axis=2)
-                    else:
-                        qfcst[curr_Itime, curr_Ilt_output, :, i] = np.nanpercentile(curr_fcst0, quantiles_orig[i] * 100, axis=2)
+                curr_fcst, curr_tfcst, curr_qfcst, curr_efcst = result[i]
+                fcst.set(curr_Itime, curr_Ilt_output, curr_fcst)
+                if len(thresholds_orig) > 0:
+                    tfcst.set(curr_Itime, curr_Ilt_output, curr_tfcst)
+                if len(quantiles_orig) > 0:
+                    qfcst.set(curr_Itime, curr_Ilt_output, curr_qfcst)
                 if num_members > 0:
-                    if curr_fcst0.shape[2] != num_members:
-                        met2verif.util.error("Number of members in file (%d) does not equal number in verif file (%d)" % (curr_fcst0.shape[2], num_members))
-                    efcst[curr_Itime, curr_Ilt_output, :, :] = curr_fcst0
+                    if curr_efcst.shape[2] != num_members:
+                        met2verif.util.error("Number of members in file (%d) does not equal number in verif file (%d)" % (curr_efcst.shape[2], num_members))
+                    efcst.set(curr_Itime, curr_Ilt_output, curr_efcst)
 
             if args.sync_frequency is not None and Iinput % args.sync_frequency == 0:
-                file.variables[args.ovariable][:] = fcst
-                if len(thresholds_orig) > 0:
-                    file.variables['cdf'][:] = tfcst
-                if len(quantiles_orig) > 0:
-                    file.variables['x'][:] = qfcst
+                for output in outputs:
+                    output.write()
                 file.sync()
-            # print "%.1f s" % (time.time() - time_s)
+        ingested += [input.filename]
+        # print "%.1f s" % (time.time() - time_s)
+
+    for output in outputs:
+        output.write()
+    file.close()
+    for output in outputs:
+        output.close()
+
+    if ledger is not None:
+        ledger.add(ingested)
+        ledger.close()
+
+
+def get_tasks(inputs, args, fcst, leadtimes_orig, times_new):
+    """ Determines which input files need to be processed and where their data goes
+
+    This is a generator, such that the check for missing data uses the output array as it
+    is when the file is about to be processed.
+
+    Yields:
+        Iinput (int): Index of the input
+        input (met2verif.fcstinput.FcstInput): The input
+        task (tuple): Itime, Ilt_input, and Ilt_output from get_time_indices. None if the
+            time indices could not be computed.
+        error (Exception): Set if the time indices could not be computed
+    """
+    for Iinput, input in enumerate(inputs):
+        try:
+            task = get_time_indices(input.leadtimes, input.forecast_reference_time, leadtimes_orig, times_new, args.delays, args.fill_time)
         except Exception as e:
-            print("Could not process: %s" % e)
+            yield Iinput, input, None, e
+            continue
+
+        """
+        Determine if we need to write data from this filename. This is only
+        when the data we are writing to is missing.
+        """
+        Itime, Ilt_input, Ilt_output = task
+        if not args.overwrite and not is_missing(fcst, Itime, Ilt_output):
             if args.debug:
-                traceback.print_exc()
+                print("Processing %s" % input.filename)
+                print("We do not need to read this file")
+            continue
+        yield Iinput, input, task, None
 
-    # Convert nans back to fill value
-    fcst[np.isnan(fcst)] = netCDF4.default_fillvals['f4']
-    file.variables[args.ovariable][:] = fcst
-    if len(thresholds_orig) > 0:
-        tfcst[np.isnan(tfcst)] = netCDF4.default_fillvals['f4']
-        file.variables['cdf'][:] = tfcst
-    if len(quantiles_orig) > 0:
-        qfcst[np.isnan(qfcst)] = netCDF4.default_fillvals['f4']
-        file.variables['x'][:] = qfcst
-    if num_members > 0:
-        efcst[np.isnan(efcst)] = netCDF4.default_fillvals['f4']
-        file.variables['ensemble'][:] = efcst
-    if is_threshold_field:
-        file.variables[args.ovariable][:, :, :, Ithreshold] = fcst
+
+def map_tasks(tasks, num_processes, args, lats, lons, thresholds, quantiles):
+    """ Runs process_input for each task, optionally in a pool of processes
+
+    Results are returned in the same order as the tasks. At most two tasks per process are
+    submitted ahead of the result being consumed, to limit memory usage.
+
+    Yields:
+        Iinput (int): Index of the input
+        input (met2verif.fcstinput.FcstInput): The input
+        task (tuple): Itime, Ilt_input, and Ilt_output
+        result (list): Output of process_input, None if an error occurred
+        error (Exception): The error raised when processing the input, otherwise None
+    """
+    if num_processes <= 1:
+        for Iinput, input, task, error in tasks:
+            result = None
+            if error is None:
+                try:
+                    result = process_input(input, task, args, lats, lons, thresholds, quantiles)
+                except Exception as e:
+                    error = e
+            yield Iinput, input, task, result, error
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(num_processes) as pool:
+        pending = collections.deque()
+        for Iinput, input, task, error in tasks:
+            future = None
+            if error is None:
+                future = pool.submit(process_input, input, task, args, lats, lons, thresholds, quantiles)
+            pending.append((Iinput, input, task, future, error))
+            while len(pending) > 2 * num_processes:
+                yield get_future_result(*pending.popleft())
+        while len(pending) > 0:
+            yield get_future_result(*pending.popleft())
+
+
+def prefetch_tasks(tasks, depth, lock, args, lats, lons, thresholds, quantiles):
+    """ Reads input files in a background thread while earlier files are processed
+
+    The background thread opens and reads input files (read_input) while the caller
+    aggregates (aggregate_input) and places the previous ones. At most depth files are read
+    ahead of the one being consumed.
+
+    Arguments:
+        tasks: Generator from get_tasks
+        depth (int): Maximum number of files read ahead
+        lock (threading.Lock): Held while reading. The caller must hold it when using the
+            netCDF library.
+
+    Yields:
+        Same as map_tasks
+    """
+    buffer = queue.Queue(depth)
+
+    def read():
+        # Errors that stop the run (e.g. SystemExit from met2verif.util.error) are passed to
+        # the caller in place of the end marker, so that they are raised as in map_tasks
+        end = None
+        try:
+            while True:
+                # Finding the tasks also reads from the output file
+                with lock:
+                    item = next(tasks, None)
+                    if item is None:
+                        break
+                    Iinput, input, task, error = item
+                    curr_fcst = None
+                    if error is None:
+                        try:
+                            curr_fcst = read_input(input, task, args, lats, lons)
+                        except Exception as e:
+                            error = e
+                buffer.put((Iinput, input, task, curr_fcst, error))
+        except BaseException as e:
+            end = e
+        finally:
+            buffer.put(end)
+
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = buffer.get()
+        if item is None:
+            break
+        elif isinstance(item, BaseException):
+            thread.join()
+            raise item
+        Iinput, input, task, curr_fcst, error = item
+        result = None
+        if error is None:
+            try:
+                result = aggregate_input(curr_fcst, task, args, thresholds, quantiles)
+            except Exception as e:
+                error = e
+        yield Iinput, input, task, result, error
+    thread.join()
+
+
+def get_future_result(Iinput, input, task, future, error):
+    result = None
+    if future is not None:
+        try:
+            result = future.result()
+        except Exception as e:
+            error = e
+    return Iinput, input, task, result, error
+
+
+def process_input(input, task, args, lats, lons, thresholds, quantiles):
+    """ Reads forecasts from one input file and computes the values for each output time
+
+    Arguments:
+        input (met2verif.fcstinput.FcstInput): The input to read from
+        task (tuple): Itime, Ilt_input, and Ilt_output from get_time_indices
+        args: Parsed command-line arguments
+        lats (np.array): Latitudes of output locations
+        lons (np.array): Longitudes of output locations
+        thresholds (np.array): Thresholds to compute CDF values for
+        quantiles (np.array): Quantiles to compute
+
+    Returns:
+        list: One (fcst, cdf, x, ensemble) tuple for each output time, with dimensions
+            (leadtime, location[, threshold/quantile/member])
+    """
+    curr_fcst = read_input(input, task, args, lats, lons)
+    return aggregate_input(curr_fcst, task, args, thresholds, quantiles)
+
+
+def read_input(input, task, args, lats, lons):
+    """ Reads forecasts from one input file for the times given by the task
+
+    Returns:
+        np.array: 3D array (input time, location, member) after applying the time window,
+            --multiply, and --add. For --winddir, a tuple with the x and y components after
+            applying the time window, since directions cannot be summed or averaged.
+    """
+    Itime, Ilt_input, Ilt_output = task
+
+    """ Only read the input times that end up in the output """
+    Ilt_used = [lt for curr_Ilt_input in Ilt_input for lt in curr_Ilt_input]
+    Itimes = get_required_times(Ilt_used, args.time_window, args.deacc)
+    variables = args.variable.split(',')
+    derive = get_derived_quantity(args)
+    if derive is None:
+        with input:
+            curr_fcst = input.extract(lats, lons, args.variable, args.members, args.hood, Itimes, args.interpolation)
     else:
-        file.variables[args.ovariable][:] = fcst
-    file.close()
+        """ Diagnose the quantity from two variables, e.g. winds from x and y """
+        func, usage = derive
+        if len(variables) != 2:
+            raise Exception("-v must be %s" % usage)
+        with input:
+            curr_x, curr_y = input.extract_variables(lats, lons, variables, args.members, args.hood, Itimes, args.interpolation)
+        if args.winddir:
+            curr_x = apply_time_window(curr_x, Ilt_used, args.time_window, args.deacc)
+            curr_y = apply_time_window(curr_y, Ilt_used, args.time_window, args.deacc)
+            return curr_x, curr_y
+        curr_fcst = func(curr_x, curr_y)
+
+    curr_fcst = apply_time_window(curr_fcst, Ilt_used, args.time_window, args.deacc)
+
+    curr_fcst = curr_fcst * args.multiply + args.add
+    return curr_fcst
+
+
+def aggregate_input(curr_fcst, task, args, thresholds, quantiles):
+    """ Computes the values for each output time from forecasts read by read_input
+
+    The statistics for all output times of the file are computed together, from one sort
+    of the member dimension.
+
+    Returns:
+        list: Same as process_input
+    """
+    Itime, Ilt_input, Ilt_output = task
+    Ilt_all = [lt for curr_Ilt_input in Ilt_input for lt in curr_Ilt_input]
+    if args.winddir:
+        """ The direction of the mean wind, which also covers neighbourhood points """
+        curr_x, curr_y = curr_fcst[0][Ilt_all, :, :], curr_fcst[1][Ilt_all, :, :]
+        curr_fcst0 = met2verif.util.compute_wind_direction(curr_x, curr_y) * args.multiply + args.add
+        fcst = compute_mean_wind_direction(curr_x, curr_y) * args.multiply + args.add
+        tfcst = np.nan * np.zeros(fcst.shape + (0,))
+        qfcst = np.nan * np.zeros(fcst.shape + (0,))
+    else:
+        curr_fcst0 = curr_fcst[Ilt_all, :, :]
+        fcst, tfcst, qfcst = compute_statistics(curr_fcst0, args.aggregator, thresholds, quantiles)
+
+    results = list()
+    start = 0
+    for i in range(len(Itime)):
+        end = start + len(Ilt_input[i])
+        results += [(fcst[start:end], tfcst[start:end], qfcst[start:end], curr_fcst0[start:end])]
+        start = end
+    return results
+
+
+def compute_statistics(values, aggregator, thresholds, quantiles):
+    """ Computes the aggregate, cdf, and quantiles over the last dimension, ignoring missing values
+
+    Arguments:
+        values (np.array): 3D array (time, location, member)
+        aggregator (str): One of "mean", "median", "min", and "max"
+        thresholds (np.array): Thresholds to compute the cdf for
+        quantiles (np.array): Quantiles (between 0 and 1) to compute
+
+    Returns:
+        fcst (np.array): 2D array (time, location) with the aggregate
+        tfcst (np.array): 3D array (time, location, threshold) with the fraction of members
+            below each threshold
+        qfcst (np.array): 3D array (time, location, quantile), linearly interpolated between
+            members like np.nanpercentile
+        All values are missing where all members are missing.
+    """
+    shape = values.shape[0:-1]
+    M = values.shape[-1]
+    K = int(np.prod(shape))
+    values = values.reshape([K, M])
+    is_valid = np.isfinite(values)
+    num_valid = np.sum(is_valid, axis=1)
+    Ivalid = np.where(num_valid > 0)[0]
+    last = np.maximum(num_valid - 1, 0)
+    thresholds = np.array(thresholds, float)
+    quantiles = np.array(quantiles, float)
+
+    # Missing values are sorted to the end of each row. The mean alone does not need sorting.
+    sorted_values = None
+    if aggregator != "mean" or len(thresholds) > 0 or len(quantiles) > 0:
+        sorted_values = np.sort(values, axis=1)
+
+    fcst = np.nan * np.zeros(K)
+    if aggregator == "mean":
+        total = np.sum(np.where(is_valid, values, 0), axis=1)
+        fcst[Ivalid] = total[Ivalid] / num_valid[Ivalid]
+    elif aggregator == "median":
+        lower = np.take_along_axis(sorted_values, (last // 2)[:, None], axis=1)[:, 0]
+        upper = np.take_along_axis(sorted_values, ((last + 1) // 2)[:, None], axis=1)[:, 0]
+        fcst[Ivalid] = (lower[Ivalid] + upper[Ivalid]) / 2
+    elif aggregator == "min":
+        fcst[Ivalid] = sorted_values[Ivalid, 0]
+    elif aggregator == "max":
+        fcst[Ivalid] = np.take_along_axis(sorted_values, last[:, None], axis=1)[Ivalid, 0]
+    else:
+        met2verif.util.error("Could not understand aggregator '%s'" % aggregator)
+
+    tfcst = np.nan * np.zeros([K, len(thresholds)])
+    if len(thresholds) > 0:
+        num_below = count_below(sorted_values, num_valid, thresholds)
+        tfcst[Ivalid] = num_below[Ivalid] / num_valid[Ivalid, None].astype(float)
+
+    qfcst = np.nan * np.zeros([K, len(quantiles)])
+    if len(quantiles) > 0:
+        position = quantiles[None, :] * last[:, None]
+        Ilower = np.floor(position).astype(int)
+        Iupper = np.minimum(Ilower + 1, last[:, None])
+        weight = position - Ilower
+        lower = np.take_along_axis(sorted_values, Ilower, axis=1)[Ivalid]
+        upper = np.take_along_axis(sorted_values, Iupper, axis=1)[Ivalid]
+        weight = weight[Ivalid]
+        diff = upper - lower
+        # Interpolate from the nearest end, in the same way as np.percentile
+        qfcst[Ivalid] = np.where(weight >= 0.5, upper - diff * (1 - weight), lower + diff * weight)
+
+    return fcst.reshape(shape), tfcst.reshape(shape + (len(thresholds),)), qfcst.reshape(shape + (len(quantiles),))
+
+
+def compute_mean_wind_direction(x, y):
+    """ Computes the direction of the mean wind over the last dimension, ignoring missing values
+
+    Arguments:
+        x (np.array): 3D array (time, location, member) with x wind components
+        y (np.array): 3D array (time, location, member) with y wind components
+
+    Returns:
+        np.array: 2D array (time, location) with the direction in degrees. Missing where all
+            members are missing or the mean wind is calm.
+    """
+    is_valid = np.isfinite(x) & np.isfinite(y)
+    # The sum has the same direction as the mean
+    total_x = np.sum(np.where(is_valid, x, 0), axis=-1)
+    total_y = np.sum(np.where(is_valid, y, 0), axis=-1)
+    return met2verif.util.compute_wind_direction(total_x, total_y)
+
+
+def count_below(sorted_values, num_valid, thresholds):
+    """ Counts the number of values below each threshold using a binary search in each row
+
+    Arguments:
+        sorted_values (np.array): 2D array where each row is sorted, with missing values last
+        num_valid (np.array): Number of non-missing values in each row
+        thresholds (np.array): Thresholds
+
+    Returns:
+        np.array: 2D array (row, threshold) of counts
+    """
+    K = sorted_values.shape[0]
+    lower = np.zeros([K, len(thresholds)], int)
+    upper = np.repeat(num_valid[:, None], len(thresholds), axis=1)
+    while (lower < upper).any():
+        searching = lower < upper
+        middle = (lower + upper) // 2
+        # Rows without valid values are never searched, so indices stay within the row
+        value = np.take_along_axis(sorted_values, np.minimum(middle, sorted_values.shape[1] - 1), axis=1)
+        is_below = np.zeros(searching.shape, bool)
+        is_below[searching] = value[searching] < np.broadcast_to(thresholds, searching.shape)[searching]
+        lower = np.where(searching & is_below, middle + 1, lower)
+        upper = np.where(searching & ~is_below, middle, upper)
+    return lower
+
+
+def is_missing(fcst, Itime, Ilt_output):
+    """ Is the output data missing for any of the slots where an input file would be written?
+
+    Arguments:
+        fcst (met2verif.timerows.TimeRows): The output variable
+        Itime (list): Output time index of each slot
+        Ilt_output (list): Output leadtime indices of each slot
+    """
+    for i in range(len(Itime)):
+        if not fcst.is_filled(Itime[i], Ilt_output[i]).all():
+            return True
+    return False
+
+
+def get_derived_quantity(args):
+    """ Determines what quantity to compute from the input variables
+
+    Returns:
+        tuple: Function that computes the quantity from two arrays, and a string describing
+            the variables it needs. None if the variable is used as is.
+    """
+    derived = list()
+    if args.windspeed:
+        derived += [(met2verif.util.compute_wind_speed, "x_variable_name,y_variable_name")]
+    if args.winddir:
+        derived += [(met2verif.util.compute_wind_direction, "x_variable_name,y_variable_name")]
+    if args.dewpoint:
+        derived += [(met2verif.util.compute_dewpoint, "temperature_variable_name,rh_variable_name")]
+    if len(derived) > 1:
+        met2verif.util.error("Only one of --windspeed, --winddir, and --dewpoint can be used")
+    elif len(derived) == 1:
+        return derived[0]
+    return None
 
 
 def get_aggregator(string):
@@ -271,9 +646,60 @@ def get_aggregator(string):
         met2verif.util.error("Could not understand aggregator '%s'" % string)
 
 
-"""
+def get_required_times(Ilt_input, time_window, deacc):
+    """ Finds which input times are needed to compute values for a set of leadtimes
+
+    Arguments:
+        Ilt_input (list): Indices of the input times that are written to the output
+        time_window (int): Time aggregation window in number of timesteps
+        deacc (bool): Deaccumulate values in time?
+
+    Returns:
+        list: Sorted indices of the input times that must be read
+    """
+    Ineeded = set()
+    for t in np.unique(np.array(Ilt_input, int)).tolist():
+        if deacc:
+            if t >= time_window:
+                Ineeded.update([t, t - time_window])
+        elif time_window == 1:
+            Ineeded.add(t)
+        elif t >= time_window:
+            Ineeded.update(range(t - time_window + 1, t + 1))
+    return sorted(Ineeded)
+
+
+def apply_time_window(values, Ilt_input, time_window, deacc):
+    """ Aggregates or deaccumulates values in time
+
+    Arguments:
+        values (np.array): Array with time as the first dimension, where at least the
+            times from get_required_times are available
+        Ilt_input (list): Indices of the input times to compute values for
+        time_window (int): Time aggregation window in number of timesteps
+        deacc (bool): If True, subtract the value time_window steps earlier. If False,
+            sum over the time_window last steps.
+
+    Returns:
+        np.array: Array with the same dimensions as values. Only times in Ilt_input are
+            computed, the others are missing.
+    """
+    assert(time_window > 0)
+    if not deacc and time_window == 1:
+        return values
+
+    output = np.nan * np.zeros(values.shape)
+    Ilt_input = np.unique(np.array(Ilt_input, int))
+    Ilt_input = Ilt_input[Ilt_input >= time_window]
+    if deacc:
+        output[Ilt_input, ...] = values[Ilt_input, ...] - values[Ilt_input - time_window, ...]
+    else:
+        output[Ilt_input, ...] = 0
+        for i in range(time_window):
+            output[Ilt_input, ...] += values[Ilt_input - i, ...]
+    return output
+
 
-"""
 def get_time_indices(input_leadtimes, input_frt, output_leadtimes, output_times, delays, fill_time):
     Itime = list()
     Ilt_input = list()
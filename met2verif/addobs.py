@@ -1,4 +1,6 @@
 import argparse
+import collections
+import concurrent.futures
 import met2verif.util
 import met2verif.version
 import netCDF4
@@ -6,9 +8,12 @@ import numpy as np
 import os
 import sys
 import met2verif.obsinput
-import met2verif.fcstinput
-import met2verif.locinput
-import met2verif.addfcst
+import met2verif.ledger
+import met2verif.timerows
+
+
+# Memory (bytes) that rows of the output variable can use before they are written and freed
+MAX_ROW_MEMORY = 512 * 2**20
 
 
 def add_subparser(parser):
@@ -16,13 +21,17 @@ def add_subparser(parser):
     subparser.add_argument('files', type=str, help='Observation files', nargs="+")
     subparser.add_argument('-c', help='Clear observations?', dest="clear", action="store_true")
     subparser.add_argument('-i', type=met2verif.util.parse_numbers, default=[0], help='Initialization hours', dest="inithours")
+    subparser.add_argument('-j', default=1, type=int, help='Number of processes to read observation files with', dest="num_processes")
     subparser.add_argument('-o', metavar="FILE", help='Verif file', dest="verif_file", required=True)
     subparser.add_argument('-s', help='Sort times if needed?', dest="sort", action="store_true")
     subparser.add_argument('-v', type=str, help='Variable name in obs files', dest="variable", required=True)
     subparser.add_argument('-vo', default="obs", type=str, help='Variable name in verif file', dest="ovariable")
     subparser.add_argument('--add', type=float, default=0, help='Add this value to all forecasts (--multiply is done before --add)')
     subparser.add_argument('--multiply', type=float, default=1, help='Multiply all forecasts with this value')
+    subparser.add_argument('--cache', metavar="DIR", help='Cache parsed observation files in this directory, for faster reading in later runs', dest="cache_dir")
     subparser.add_argument('--debug', help='Display debug information', action="store_true")
+    subparser.add_argument('--ledger', metavar="FILE", help='Record added files in this SQLite file, and skip files that have been added before with the same options and have not changed since')
+    subparser.add_argument('--max_distance', default=1000, type=float, help='Maximum distance (m) between observations without station ids (Titan) and the location they are matched to')
     subparser.add_argument('--force_range', metavar="MIN,MAX", type=met2verif.util.parse_numbers, help='Remove values outside the range min,max', dest="range")
 
     return subparser
@@ -45,100 +54,258 @@ def run(parser, argv=sys.argv[1:]):
 
     ids_orig = np.array(file.variables["location"][:])
     leadtimes_orig = np.array(file.variables["leadtime"][:])
+    lats_orig = np.array(file.variables["lat"][:])
+    lons_orig = np.array(file.variables["lon"][:])
+    locations = dict()
+    for i in range(len(ids_orig)):
+        locations[ids_orig[i]] = {"lat": lats_orig[i], "lon": lons_orig[i]}
+
+    filenames = args.files
+    ledger = None
+    if args.ledger is not None:
+        ledger = met2verif.ledger.Ledger(args.ledger, args.verif_file, args.ovariable, met2verif.ledger.get_options_hash(args))
+        if args.clear:
+            ledger.clear()
+        else:
+            filenames = [filename for filename in filenames if not ledger.has(filename)]
+            if args.debug:
+                print("Skipping %d files that have already been added" % (len(args.files) - len(filenames)))
 
     """
-    Create a dictionary where new observations from the files are added
+    Observations already in the file are read, and new observations written, only for the
+    times that the new observations are placed in
     """
-    data = {"times": np.zeros(0, int), "ids": np.zeros(0, int), "obs": np.zeros(0)}
-    for filename in args.files:
+    times_new = np.array(times_orig, float)
+    valid_times = get_valid_times(times_new, leadtimes_orig)
+    row_size = 8 * int(np.prod(file.variables[args.ovariable].shape[1:]))
+    max_rows = max(1, MAX_ROW_MEMORY // row_size)
+    obs = met2verif.timerows.TimeRows(file.variables[args.ovariable], clear=args.clear, num_existing=len(times_orig), max_rows=max_rows)
+    if args.clear:
+        obs.clear(len(times_orig))
+
+    if args.range is not None:
+        if len(args.range) != 2:
+            met2verif.util.error("--force_range must be a vector of length 2")
+
+    """
+    Read the files in chunks, and place each chunk in the rows of the output before reading
+    the next, such that memory usage does not depend on the size of the files. The rows are
+    only written when they use more than MAX_ROW_MEMORY, since input files sorted by station
+    touch most of the rows in every chunk. Files can be read in
+    parallel, but are placed in the order of the input files, such that the output is the
+    same as when the files are read one after another.
+    """
+    ingested = list()
+    options = {"cache_dir": args.cache_dir, "locations": locations, "max_distance": args.max_distance}
+    for filename, chunks in map_files(filenames, args.variable, args.num_processes, options):
         try:
-            input = met2verif.obsinput.get(filename)
-            curr_data = input.read(args.variable)
-            for key in data:
-                data[key] = np.append(data[key], curr_data[key])
+            for data in chunks:
+                """
+                New times are always added after the existing times, such that only the new
+                part of the time dimension needs to be written, and existing records are left
+                untouched.
+                """
+                times_add = get_new_times(data["times"], times_new, leadtimes_orig, args.inithours)
+                if args.debug and len(times_add) > 0:
+                    print("Adding new intialization times:\n    " + '\n '.join([met2verif.util.unixtime_to_str(t) for t in times_add]))
+                if len(times_add) > 0:
+                    file.variables["time"][len(times_new):] = times_add
+                    times_new = np.append(times_new, times_add)
+                    valid_times = np.append(valid_times, get_valid_times(times_add, leadtimes_orig), axis=0)
+                place(obs, data, valid_times, ids_orig, args)
+            ingested += [filename]
         except Exception as e:
             print("Could not load file %s" % filename)
+    obs.flush()
 
     """
-    Read the existing observation data and expand array to allow for the new times
-    to be added. This array can be resorted such that times are in chronological order.
+    Times added by different chunks can be out of order. Sort the added times, or all times
+    if requested.
     """
-    file_valid_times = np.unique(data["times"]).tolist()
-    file_avail_init_times = list()
-    for leadtime_orig in leadtimes_orig:
-        file_avail_init_times += [(t - leadtime_orig * 3600) for t in file_valid_times]
-    times_file = [t for t in file_avail_init_times if (t % 86400)/3600 in args.inithours]
-    times_all = np.unique(np.append(times_orig, times_file))
-    times_add = np.sort(np.setdiff1d(times_all, times_orig))
-    times_new = np.append(times_orig, times_add)
-    if args.debug:
-        if len(times_add) == 0:
-            print("No new initialization times added")
-        else:
-            print("Adding new intialization times:\n    " + '\n '.join([met2verif.util.unixtime_to_str(t) for t in times_add]))
+    if args.sort:
+        Itimes = np.argsort(times_new)
+    else:
+        Itimes = np.append(np.arange(len(times_orig)), len(times_orig) + np.argsort(times_new[len(times_orig):]))
+    if (Itimes != range(len(times_new))).any():
+        if args.debug:
+            print("Sorting times to be in ascending order")
+        sort_times(file, Itimes)
+
+    file.close()
 
-    new_ids = [id for id in np.unique(data["ids"]) if id in ids_orig]
-    valid_times = np.zeros([len(times_new), len(leadtimes_orig)], int)
-    for t in range(len(times_new)):
-        for l in range(len(leadtimes_orig)):
-            valid_times[t, l] = times_new[t] + leadtimes_orig[l] * 3600
+    if ledger is not None:
+        ledger.add(ingested)
+        ledger.close()
 
-    obs = np.nan * np.zeros([len(times_new), len(leadtimes_orig), len(ids_orig)])
-    if len(times_orig) > 0 and not args.clear:
-        obs[range(len(times_orig)), :, :] = file.variables[args.ovariable][:]
 
-    if args.sort:
-        Itimes = np.argsort(times_new)
-        if (Itimes != range(len(times_new))).any():
-            if args.debug:
-                print("Sorting times to be in ascending order")
-            times_new = times_new[Itimes]
-            obs = obs[Itimes, :, :]
-            file.variables["fcst"][:] = file.variables["fcst"][Itimes, :, :]
+def map_files(filenames, variable, num_processes, options=dict()):
+    """ Reads observation files, optionally in a pool of processes
 
-    file.variables["time"][:] = times_new
+    With one process, each file is read in chunks as the chunks are used. Otherwise, each
+    process reads a whole file and returns its observations as one chunk. At most two
+    files per process are read ahead of the file being consumed, to limit memory usage.
 
+    Arguments:
+        options (dict): Keyword arguments to met2verif.obsinput.get
+
+    Yields:
+        filename (str): The file
+        chunks: Iterable of observations (dict from met2verif.obsinput.ObsInput.read).
+            Iterating over it raises the error encountered when reading the file.
+    """
+    if num_processes <= 1:
+        for filename in filenames:
+            yield filename, read_file_chunks(filename, variable, options)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(num_processes) as pool:
+        pending = collections.deque()
+        for filename in filenames:
+            pending.append((filename, pool.submit(read_file, filename, variable, options)))
+            while len(pending) > 2 * num_processes:
+                filename, future = pending.popleft()
+                yield filename, get_future_chunks(future)
+        while len(pending) > 0:
+            filename, future = pending.popleft()
+            yield filename, get_future_chunks(future)
+
+
+def read_file_chunks(filename, variable, options=dict()):
+    input = met2verif.obsinput.get(filename, **options)
+    for data in input.read_chunks(variable):
+        yield data
+
+
+def read_file(filename, variable, options=dict()):
+    input = met2verif.obsinput.get(filename, **options)
+    return input.read(variable)
+
+
+def get_future_chunks(future):
+    yield future.result()
+
+
+def get_valid_times(times, leadtimes):
+    """ Computes the valid time of each time and leadtime
+
+    Returns:
+        np.array: 2D array (time, leadtime) of unixtimes
+    """
+    times = np.reshape(np.array(times, float), [-1, 1])
+    leadtimes = np.reshape(leadtimes, [1, -1])
+    return (times + leadtimes * 3600).astype(int)
+
+
+def get_new_times(obs_times, times, leadtimes, inithours):
+    """ Finds initialization times that observations can be placed in, but that are not in the file
+
+    Arguments:
+        obs_times (np.array): Valid times of the observations
+        times (np.array): Initialization times in the file
+        leadtimes (np.array): Leadtimes in the file (hours)
+        inithours (list): Only add initialization times at these hours of the day
+
+    Returns:
+        np.array: Sorted new initialization times
+    """
+    # Compute in float64, since float32 leadtimes would otherwise round the unixtimes
+    file_valid_times = np.array(np.unique(obs_times), float)
+    file_avail_init_times = (np.reshape(file_valid_times, [-1, 1]) - np.reshape(np.array(leadtimes, float), [1, -1]) * 3600).flatten()
+    times_file = file_avail_init_times[np.isin((file_avail_init_times % 86400) / 3600, inithours)]
+    times_all = np.unique(np.append(times, times_file))
+    return np.sort(np.setdiff1d(times_all, times))
+
+
+def place(obs, data, valid_times, ids_orig, args):
     """
     Place each new observation into the appropriate time and leadtime slots
 
-    Use a precomputed dictionary to speed of the time it takes to lookup which
-    indices correspond to a particular time.
+    All observations are matched to slots at once: ids are looked up in the sorted location
+    ids, and valid times in the sorted valid times of the slots. If several observations
+    fall in the same slot, the last one in the input is used.
+
+    Arguments:
+        obs (met2verif.timerows.TimeRows): Output variable
+        data (dict): Observations from met2verif.obsinput.ObsInput.read
+        valid_times (np.array): Valid times of the slots in the file (see get_valid_times)
+        ids_orig (np.array): Location ids in the file
+        args (argparse.Namespace): Command-line arguments
     """
-    map_time = dict()
-    for curr_valid_time in np.unique(data["times"]):
-        II = np.where(valid_times == curr_valid_time)
-        map_time[curr_valid_time] = II
+    Iloc = get_location_indices(ids_orig, data["ids"])
+    Iobs = np.where(Iloc >= 0)[0]
 
-    for i, id in enumerate(new_ids):
-        if args.debug:
-            step = len(new_ids) / 100
-            frac = float(i) / len(new_ids)
-            if len(new_ids) > 100 and i % step == 0:
-                # if int(frac * 100) % 5 == 0:
-                met2verif.util.progress_bar(frac, 80)
-        I = np.where(data["ids"] == id)[0]
-        Iloc = np.where(ids_orig == id)[0][0]
-        curr_valid_times = data["times"][I]
-        curr_obs = data["obs"][I]
-
-        for j in range(len(curr_obs)):
-            curr_valid_time = curr_valid_times[j]
-            II = map_time[curr_valid_time]
-            if len(II[0]) > 0:
-                value = curr_obs[j]
-                if curr_obs[j] not in [-999, 99999]:
-                    value *= args.multiply + args.add
-                obs[II[0], II[1], [Iloc]*len(II[0])] = value
+    """ Find all slots with the same valid time as each observation """
+    num_leadtimes = valid_times.shape[1]
+    Isorted = np.argsort(valid_times.flatten(), kind="stable")
+    sorted_valid_times = valid_times.flatten()[Isorted]
+    start = np.searchsorted(sorted_valid_times, data["times"][Iobs], side="left")
+    count = np.searchsorted(sorted_valid_times, data["times"][Iobs], side="right") - start
+    Iobs = np.repeat(Iobs, count)
+    offset = np.arange(len(Iobs)) - np.repeat(np.cumsum(count) - count, count)
+    Islot = Isorted[np.repeat(start, count) + offset]
+    Itime = Islot // num_leadtimes
+    Ilt = Islot % num_leadtimes
+    Iloc = Iloc[Iobs]
 
+    """ Only keep the last observation for each slot """
+    key = (Itime * num_leadtimes + Ilt) * len(ids_orig) + Iloc
+    _, Ilast = np.unique(key[::-1], return_index=True)
+    Ilast = len(key) - 1 - Ilast
+    Itime = Itime[Ilast]
+    Ilt = Ilt[Ilast]
+    Iloc = Iloc[Ilast]
+
+    values = np.array(data["obs"][Iobs[Ilast]], float)
+    Ivalid = (values != -999) & (values != 99999)
+    values[Ivalid] = values[Ivalid] * args.multiply + args.add
     """ Remove observations outside range """
     if args.range is not None:
-        if len(args.range) != 2:
-            met2verif.util.error("--force_range must be a vector of length 2")
-        obs[obs < args.range[0]] = np.nan
-        obs[obs > args.range[1]] = np.nan
+        with np.errstate(invalid="ignore"):
+            values[(values < args.range[0]) | (values > args.range[1])] = np.nan
 
-    obs[np.isnan(obs)] = netCDF4.default_fillvals['f4']
-    file.variables[args.ovariable][:] = obs
+    if args.debug:
+        print("Placing %d observations in %d slots" % (len(np.unique(Iobs)), len(values)))
+    for curr_time in np.unique(Itime):
+        I = np.where(Itime == curr_time)[0]
+        obs.set(curr_time, (Ilt[I], Iloc[I]), values[I])
 
-    curr_times = list()
-    file.close()
+
+def get_location_indices(ids, new_ids):
+    """ Finds the index of each new id in ids
+
+    Arguments:
+        ids (np.array): Location ids in the file
+        new_ids (np.array): Location ids to look up
+
+    Returns:
+        np.array: Index of the first location with each id, or -1 if the id is not found
+    """
+    if len(ids) == 0:
+        return -np.ones(len(new_ids), int)
+    Isorted = np.argsort(ids, kind="stable")
+    I = np.searchsorted(ids[Isorted], new_ids)
+    I = np.minimum(I, len(ids) - 1)
+    return np.where(ids[Isorted][I] == new_ids, Isorted[I], -1)
+
+
+def sort_times(file, Itimes, chunk_size=100):
+    """ Reorders all variables with a time dimension in a verif file
+
+    Only the records from the first one that moves are read and written.
+
+    Arguments:
+        file (netCDF4.Dataset): Verif file opened for writing
+        Itimes (np.array): New order of the time indices
+        chunk_size (int): Number of times to read at a time
+    """
+    Imoved = np.where(Itimes != np.arange(len(Itimes)))[0]
+    if len(Imoved) == 0:
+        return
+    first = Imoved[0]
+    Itimes = Itimes[first:]
+    for name in file.variables:
+        var = file.variables[name]
+        if len(var.dimensions) == 0 or var.dimensions[0] != "time":
+            continue
+        values = np.ma.concatenate([var[Itimes[start:start + chunk_size], ...] for start in range(0, len(Itimes), chunk_size)])
+        var[first:] = values
@@ -5,13 +5,10 @@ import netCDF4
 import numpy as np
 import os
 import re
-import requests
 import sys
 import urllib.request
 
-import met2verif.fcstinput
 import met2verif.locinput
-import met2verif.obsinput
 import met2verif.util
 import met2verif.version
 
@@ -34,6 +31,7 @@ def add_subparser(parser):
 
 
 def run(parser, argv=sys.argv[1:]):
+    import requests
     args = parser.parse_args(argv)
 
     variables = args.variables.split(',')
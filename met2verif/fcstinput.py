@@ -2,20 +2,20 @@ import met2verif.util
 import sys
 import netCDF4
 import numpy as np
-import scipy.interpolate
 import datetime
 import copy
+import hashlib
+import os
 import argparse
 import calendar
+import contextlib
 import time
-import verif.data
-import verif.input
-import scipy.spatial
-import pyproj
 
+# scipy and pyproj are slow to import, so they are imported in the functions that use them
 
-def get(filename):
-    return Netcdf(filename)
+
+def get(filename, cache_dir=None):
+    return Netcdf(filename, cache_dir=cache_dir)
 
 
 def get_field(data, ml=0, member=None):
@@ -49,11 +49,12 @@ def get_field(data, ml=0, member=None):
 
 def convert_times(times, ncvar):
     if hasattr(ncvar, "units"):
+        calendar = getattr(ncvar, "calendar", "standard")
         if isinstance(times, list) or isinstance(times, np.ndarray):
-            times = np.array([met2verif.util.convert_time(times[t], ncvar.units) for t in range(len(times))])
+            times = met2verif.util.convert_time(np.array(times), ncvar.units, calendar)
         else:
             if not np.isnan(times):
-                times = met2verif.util.convert_time(times, ncvar.units)
+                times = met2verif.util.convert_time(times, ncvar.units, calendar)
         return times
 
         # units = ncvar.units
@@ -64,6 +65,426 @@ def convert_times(times, ncvar):
     else:
         return times
 
+# Nearest neighbour lookups and interpolation weights shared by all Netcdf objects in
+# this process. Keys are computed by get_grid_key (with the interpolation method appended
+# for weights) and values are (I, J) or (I, J, W) tuples.
+_index_cache = dict()
+
+
+def get_grid_key(grid, lats, lons):
+    """ Computes a fingerprint of a grid and a set of lookup points
+
+    Arguments:
+        grid (dict): Grid description from Netcdf.get_grid
+        lats (np.array): Latitudes of lookup points
+        lons (np.array): Longitudes of lookup points
+
+    Returns:
+        str: Hexadecimal digest identifying the lookup
+    """
+    h = hashlib.sha1()
+    h.update(str(grid["type"]).encode("utf-8"))
+    h.update(str(grid["projection"]).encode("utf-8"))
+    for array in [grid["x"], grid["y"], grid["lats"], grid["lons"], lats, lons]:
+        if array is None:
+            h.update(b"None")
+        else:
+            array = np.ascontiguousarray(np.ma.filled(array, np.nan), float)
+            h.update(str(array.shape).encode("utf-8"))
+            h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def get_nearest_index(axis, values, period=None):
+    """ Finds the nearest point on a 1D coordinate axis using a binary search
+
+    Arguments:
+        axis (np.array): Coordinates that are either increasing or decreasing
+        values (np.array): Values to look up
+        period (float): Treat coordinates as periodic with this period (e.g. 360 for
+            longitudes), such that values can be on a different range than the axis
+            and the nearest point can be across the wrap-around
+
+    Returns:
+        np.array: Index into axis for each value
+    """
+    axis = np.array(axis, float)
+    values = np.array(values, float)
+    N = len(axis)
+    if N == 1:
+        return np.zeros(len(values), int)
+
+    Isort = np.arange(N)
+    if axis[-1] < axis[0]:
+        Isort = Isort[::-1]
+    sorted_axis = axis[Isort]
+    if period is not None:
+        values = (values - sorted_axis[0]) % period + sorted_axis[0]
+
+    Iupper = np.clip(np.searchsorted(sorted_axis, values), 1, N - 1)
+    Ilower = Iupper - 1
+    dist_lower = np.abs(values - sorted_axis[Ilower])
+    dist_upper = np.abs(values - sorted_axis[Iupper])
+    # Resolve ties in favour of the first index in the file, like np.argmin does
+    use_upper = (dist_upper < dist_lower) | ((dist_upper == dist_lower) & (Isort[Iupper] < Isort[Ilower]))
+    I = np.where(use_upper, Iupper, Ilower)
+    if period is not None:
+        dist = np.minimum(dist_lower, dist_upper)
+        dist_wrap = np.abs(sorted_axis[0] + period - values)
+        I[dist_wrap < dist] = 0
+    return Isort[I]
+
+
+def compute_i_j(grid, lats, lons):
+    """ Finds the nearest neighbour in a grid for a list of lookup points
+
+    Arguments:
+        grid (dict): Grid description from Netcdf.get_grid
+        lats (list): Latitudes
+        lons (list): Longitudes
+
+    Returns:
+        I (np.array): I indices, -1 if outside domain
+        J (np.array): J indices, -1 if outside domain
+    """
+    import pyproj
+    import scipy.spatial
+    Npoints = len(lats)
+    I = list()
+    J = list()
+    if grid["type"] == "regular":
+        # TODO: This assumes that latitude is before longitude in the dimensions of a variable
+        I = get_nearest_index(np.ma.filled(grid["lats"], np.nan), lats)
+        J = get_nearest_index(np.ma.filled(grid["lons"], np.nan), lons, 360)
+    elif grid["type"] == "projected":
+        proj = pyproj.Proj(grid["projection"])
+        x = grid["x"]
+        y = grid["y"]
+
+        # Project lat lon onto grid projection
+        xx, yy = proj(lons, lats)
+        Ix = np.argsort(x)
+        Iy = np.argsort(y)
+        IIx = np.argsort(Ix)
+        IIy = np.argsort(Iy)
+        J = [IIx[int(xxx)] for xxx in np.round(np.interp(xx, x[Ix], range(len(x)), 0, len(x) - 1))]
+        I = [IIy[int(yyy)] for yyy in np.round(np.interp(yy, y[Iy], range(len(y)), 0, len(y) - 1))]
+    else:
+        print("Could not find projection. Computing nearest neighbour from lat/lon.")
+        ilats = grid["lats"]
+        ilons = grid["lons"]
+        if len(ilats.shape) == 1:
+            # Global lat/lon data
+            ilons, ilats = np.meshgrid(ilons, ilats)
+        ilats = np.ma.filled(ilats, np.nan).astype(float)
+        ilons = np.ma.filled(ilons, np.nan).astype(float)
+
+        # Search for all points at once in a tree of earth-centred coordinates. The
+        # nearest neighbour in 3D is also the nearest along the great circle.
+        Igrid = np.where(np.isfinite(ilats.flatten()) & np.isfinite(ilons.flatten()))[0]
+        tree = scipy.spatial.cKDTree(met2verif.util.lat_lon_to_xyz(ilats.flatten()[Igrid], ilons.flatten()[Igrid]))
+        lats = np.array(lats, float)
+        lons = np.array(lons, float)
+        Ivalid = np.where(np.isfinite(lats) & np.isfinite(lons))[0]
+        I = -np.ones(Npoints, int)
+        J = -np.ones(Npoints, int)
+        if len(Ivalid) > 0 and len(Igrid) > 0:
+            _, Inearest = tree.query(met2verif.util.lat_lon_to_xyz(lats[Ivalid], lons[Ivalid]))
+            indices = np.unravel_index(Igrid[Inearest], ilats.shape)
+            I[Ivalid] = indices[0]
+            if len(indices) == 2:
+                J[Ivalid] = indices[1]
+            else:
+                J[Ivalid] = 0
+    return np.array(I, int), np.array(J, int)
+
+
+def get_cell(axis, values, period=None):
+    """ Finds the pair of points on a 1D coordinate axis that surround each value
+
+    Arguments:
+        axis (np.array): Coordinates that are either increasing or decreasing
+        values (np.array): Values to look up
+        period (float): Treat coordinates as periodic with this period (e.g. 360 for
+            longitudes), such that values between the last and the first point of a
+            global axis are placed in the cell across the wrap-around
+
+    Returns:
+        I0 (np.array): Index into axis of the first point of the cell
+        I1 (np.array): Index into axis of the second point of the cell
+        frac (np.array): Position of the value within the cell (0 at I0 and 1 at I1)
+        valid (np.array): True if the value is inside the axis
+    """
+    axis = np.array(axis, float)
+    values = np.array(values, float)
+    N = len(axis)
+    finite = np.isfinite(values)
+    values = np.where(finite, values, axis[0])
+    if N == 1:
+        zeros = np.zeros(len(values), int)
+        return zeros, zeros, np.zeros(len(values)), finite & (values == axis[0])
+
+    Isort = np.arange(N)
+    if axis[-1] < axis[0]:
+        Isort = Isort[::-1]
+    sorted_axis = axis[Isort]
+    if period is not None:
+        values = (values - sorted_axis[0]) % period + sorted_axis[0]
+
+    I1 = np.clip(np.searchsorted(sorted_axis, values, side="right"), 1, N - 1)
+    I0 = I1 - 1
+    frac = (values - sorted_axis[I0]) / (sorted_axis[I1] - sorted_axis[I0])
+    valid = finite & (values >= sorted_axis[0]) & (values <= sorted_axis[-1])
+    if period is not None:
+        gap = sorted_axis[0] + period - sorted_axis[-1]
+        if gap <= np.max(np.diff(sorted_axis)) * 1.001:
+            Iwrap = np.where(finite & (values > sorted_axis[-1]))[0]
+            I0[Iwrap] = N - 1
+            I1[Iwrap] = 0
+            frac[Iwrap] = (values[Iwrap] - sorted_axis[-1]) / gap
+            valid[Iwrap] = True
+    return Isort[I0], Isort[I1], frac, valid
+
+
+def get_inverse_distance_weights(dist):
+    """ Computes inverse distance squared weights
+
+    Arguments:
+        dist (np.array): 2D array (point, neighbour) of distances
+
+    Returns:
+        np.array: Weights with the same dimensions as dist. A point that coincides with a
+            neighbour gets all its weight from that neighbour.
+    """
+    exact = dist == 0
+    weights = exact.astype(float)
+    Inot_exact = np.where(~exact.any(axis=1))[0]
+    weights[Inot_exact] = 1.0 / dist[Inot_exact] ** 2
+    return weights
+
+
+def compute_weights(grid, lats, lons, method):
+    """ Computes interpolation weights from the gridpoints in a grid to a list of lookup points
+
+    Bilinear interpolation uses the four gridpoints around each point, on the projected
+    coordinates for projected grids and on latitude and longitude for regular grids. Inverse
+    distance weighting uses the same four gridpoints, or the four nearest gridpoints on
+    grids without 1D coordinates, where bilinear interpolation also falls back to inverse
+    distance weighting.
+
+    Arguments:
+        grid (dict): Grid description from Netcdf.get_grid
+        lats (list): Latitudes
+        lons (list): Longitudes
+        method (str): One of "bilinear" and "idw"
+
+    Returns:
+        I (np.array): Row index of each gridpoint used
+        J (np.array): Column index of each gridpoint used
+        W (scipy.sparse.csr_matrix): Weights with dimensions (lookup point, gridpoint used).
+            Rows of points outside the domain are empty.
+    """
+    import pyproj
+    import scipy.sparse
+    import scipy.spatial
+    if method not in ["bilinear", "idw"]:
+        raise ValueError("Unknown interpolation method '%s'" % method)
+    lats = np.array(lats, float)
+    lons = np.array(lons, float)
+    Npoints = len(lats)
+
+    if grid["type"] in ["regular", "projected"]:
+        if grid["type"] == "regular":
+            xaxis = np.ma.filled(grid["lons"], np.nan).astype(float)
+            yaxis = np.ma.filled(grid["lats"], np.nan).astype(float)
+            xx = lons
+            yy = lats
+            period = 360
+        else:
+            proj = pyproj.Proj(grid["projection"])
+            xaxis = np.ma.filled(grid["x"], np.nan).astype(float)
+            yaxis = np.ma.filled(grid["y"], np.nan).astype(float)
+            xx, yy = proj(lons, lats)
+            xx = np.array(xx, float)
+            yy = np.array(yy, float)
+            period = None
+        J0, J1, fx, valid_x = get_cell(xaxis, xx, period)
+        I0, I1, fy, valid_y = get_cell(yaxis, yy)
+        I = np.stack([I0, I0, I1, I1], axis=1)
+        J = np.stack([J0, J1, J0, J1], axis=1)
+        valid = valid_x & valid_y
+        if method == "bilinear":
+            W = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=1)
+        else:
+            W = np.zeros(I.shape)
+            Ivalid = np.where(valid)[0]
+            if grid["type"] == "regular":
+                dist = met2verif.util.distance(lats[Ivalid, None], lons[Ivalid, None], yaxis[I[Ivalid]], xaxis[J[Ivalid]])
+            else:
+                dist = np.sqrt((xaxis[J[Ivalid]] - xx[Ivalid, None]) ** 2 + (yaxis[I[Ivalid]] - yy[Ivalid, None]) ** 2)
+            W[Ivalid] = get_inverse_distance_weights(dist)
+    else:
+        ilats = grid["lats"]
+        ilons = grid["lons"]
+        if len(ilats.shape) == 1:
+            ilons, ilats = np.meshgrid(ilons, ilats)
+        ilats = np.ma.filled(ilats, np.nan).astype(float)
+        ilons = np.ma.filled(ilons, np.nan).astype(float)
+
+        Igrid = np.where(np.isfinite(ilats.flatten()) & np.isfinite(ilons.flatten()))[0]
+        num_neighbours = min(4, len(Igrid))
+        valid = np.isfinite(lats) & np.isfinite(lons) & (num_neighbours > 0)
+        I = np.zeros([Npoints, num_neighbours], int)
+        J = np.zeros([Npoints, num_neighbours], int)
+        W = np.zeros([Npoints, num_neighbours])
+        Ivalid = np.where(valid)[0]
+        if len(Ivalid) > 0:
+            tree = scipy.spatial.cKDTree(met2verif.util.lat_lon_to_xyz(ilats.flatten()[Igrid], ilons.flatten()[Igrid]))
+            dist, Inearest = tree.query(met2verif.util.lat_lon_to_xyz(lats[Ivalid], lons[Ivalid]), num_neighbours)
+            dist = dist.reshape([len(Ivalid), num_neighbours])
+            Inearest = Inearest.reshape([len(Ivalid), num_neighbours])
+            indices = np.unravel_index(Igrid[Inearest], ilats.shape)
+            I[Ivalid] = indices[0]
+            if len(indices) == 2:
+                J[Ivalid] = indices[1]
+            W[Ivalid] = get_inverse_distance_weights(dist)
+
+    # Only keep gridpoints that contribute, and number them in the order they are read
+    keep = valid[:, None] & (W > 0)
+    rows = np.repeat(np.arange(Npoints)[:, None], W.shape[1], axis=1)[keep]
+    num_columns = np.max(J[keep]) + 1 if keep.any() else 1
+    Iflat, Icolumn = np.unique(I[keep] * num_columns + J[keep], return_inverse=True)
+    W = scipy.sparse.csr_matrix((W[keep], (rows, Icolumn.flatten())), shape=(Npoints, len(Iflat)))
+    return Iflat // num_columns, Iflat % num_columns, W
+
+
+def apply_weights(W, values):
+    """ Interpolates values at gridpoints to lookup points
+
+    Gridpoints with missing values are left out and the remaining weights are rescaled.
+
+    Arguments:
+        W (scipy.sparse.csr_matrix): Weights from compute_weights
+        values (np.array): 3D array (time, gridpoint, member)
+
+    Returns:
+        np.array: 3D array (time, lookup point, member). Points without any valid gridpoints
+            are missing.
+    """
+    T, P, M = values.shape
+    values = values.transpose(1, 0, 2).reshape([P, T * M])
+    is_valid = np.isfinite(values)
+    total = W.dot(np.where(is_valid, values, 0))
+    weight = W.dot(is_valid.astype(float))
+    output = np.nan * np.zeros(total.shape)
+    Ivalid = weight > 0
+    output[Ivalid] = total[Ivalid] / weight[Ivalid]
+    return output.reshape([W.shape[0], T, M]).transpose(1, 0, 2)
+
+
+def get_read_blocks(I, J, point_size=1, max_gap=8, max_size=10**7):
+    """ Groups grid points into rectangular blocks that can be read together
+
+    Points are visited row by row, and nearby points share a block as long as the
+    block stays below a maximum size.
+
+    Arguments:
+        I (np.array): Row index of each point
+        J (np.array): Column index of each point
+        point_size (int): Number of values read for each gridpoint (e.g. times x members)
+        max_gap (int): Start a new block if the next point is more than this many rows away
+        max_size (int): Maximum number of values in one block
+
+    Returns:
+        list: One (row_start, row_end, col_start, col_end, Ipoints) tuple for each block,
+            where the ends are inclusive and Ipoints are indices into I and J
+    """
+    blocks = list()
+    Isort = np.lexsort((J, I))
+    curr = None
+    for k in Isort:
+        i = I[k]
+        j = J[k]
+        if curr is not None:
+            r0, r1, c0, c1, Ipoints = curr
+            c0_new = min(c0, j)
+            c1_new = max(c1, j)
+            size = (i - r0 + 1) * (c1_new - c0_new + 1) * point_size
+            if i - r1 <= max_gap and size <= max_size:
+                Ipoints.append(k)
+                curr = (r0, i, c0_new, c1_new, Ipoints)
+                continue
+            blocks.append(curr)
+        curr = (i, i, j, j, [k])
+    if curr is not None:
+        blocks.append(curr)
+    return blocks
+
+
+def read_points(var, I_time, I_y, I_x, I_ens, I, J, members=None, Itimes=None):
+    """ Reads the values of a variable at a set of gridpoints
+
+    Arguments:
+        var (netCDF4.Variable): Variable to read from
+        I_time (int): Index of the time dimension
+        I_y (int): Index of the y dimension
+        I_x (int): Index of the x dimension, None if the variable has no x dimension
+        I_ens (int): Index of the ensemble dimension, None if there is no such dimension
+        I (np.array): Row (y) index of each point
+        J (np.array): Column (x) index of each point. Ignored if I_x is None.
+        members (list): Ensemble members to read, if I_ens is not None
+        Itimes (list): Indices of the times to read. If None, then read all times.
+
+    Returns:
+        np.array: 3D array (time, point, member). Points outside the grid are missing.
+    """
+    I = np.array(I, int)
+    J = np.array(J, int)
+    if I_x is None:
+        J = np.zeros(len(I), int)
+    Y = var.shape[I_y]
+    X = 1 if I_x is None else var.shape[I_x]
+    if Itimes is None:
+        Itimes = range(var.shape[I_time])
+    Itimes = list(Itimes)
+    T = len(Itimes)
+    M = 1 if I_ens is None else len(members)
+    values = np.nan * np.zeros([T, len(I), M])
+    if T == 0:
+        return values
+
+    Iinside = np.where((I >= 0) & (I < Y) & (J >= 0) & (J < X))[0]
+    for r0, r1, c0, c1, Ipoints in get_read_blocks(I[Iinside], J[Iinside], T * M):
+        index = list()
+        for d in range(len(var.dimensions)):
+            if d == I_time:
+                index += [Itimes]
+            elif d == I_y:
+                index += [slice(r0, r1 + 1)]
+            elif d == I_x:
+                index += [slice(c0, c1 + 1)]
+            elif d == I_ens:
+                index += [members]
+            else:
+                # Use the first level of any other dimension
+                index += [0]
+        block = var[tuple(index)]
+        block = np.ma.filled(block.astype(float), np.nan)
+
+        # Get the block into the format time, y, x, ensemble_member
+        kept = [d for d in range(len(var.dimensions)) if d in [I_time, I_y, I_x, I_ens]]
+        order = [kept.index(d) for d in [I_time, I_y, I_x, I_ens] if d is not None]
+        block = np.transpose(block, order)
+        if I_x is None:
+            block = np.expand_dims(block, 2)
+        if I_ens is None:
+            block = np.expand_dims(block, 3)
+
+        Ipoints = Iinside[Ipoints]
+        values[:, Ipoints, :] = block[:, I[Ipoints] - r0, J[Ipoints] - c0, :]
+    return values
+
+
 class FcstInput(object):
     def read(self, variable):
         """
@@ -80,13 +501,30 @@ class FcstInput(object):
 
 
 class Netcdf(FcstInput):
-    def __init__(self, filename, coord_guess=None):
+    """
+    Forecasts from a netCDF file. The file is opened whenever data is needed, unless the
+    object is used as a context manager (or open() is called), in which case all calls
+    reuse the same open file until the session is closed:
+
+    with met2verif.fcstinput.get(filename) as input:
+        values = input.extract(lats, lons, variable)
+    """
+    def __init__(self, filename, coord_guess=None, cache_dir=None):
+        """
+        Arguments:
+            filename (str): Forecast file
+            cache_dir (str): Directory where nearest neighbour lookups are cached between
+                runs. If None, lookups are only cached in memory.
+        """
         self.filename = filename
+        self.cache_dir = cache_dir
         self.times = None
         self.forecast_reference_time = None
         self.leadtimes = None
+        self.session = None
         try:
             with netCDF4.Dataset(self.filename, 'r') as file:
+                self.dimensions = dict([(name, len(dim)) for name, dim in file.dimensions.items()])
                 if "time" in file.variables:
                     if len(file.variables["time"]) > 0:
                         self.times = file.variables["time"][:]
@@ -95,14 +533,14 @@ class Netcdf(FcstInput):
                         print("Warning: File '%s' does not have any times" % self.filename)
                 else:
                     print("Warning: File '%s' does not have any times" % self.filename)
-                self.variables = file.variables.keys()
+                self.variables = list(file.variables.keys())
 
                 if "forecast_reference_time" in file.variables:
                     self.forecast_reference_time = np.ma.filled(file.variables["forecast_reference_time"], fill_value=np.nan)
                     self.forecast_reference_time = float(self.forecast_reference_time)
                     self.forecast_reference_time = convert_times(self.forecast_reference_time, file.variables["forecast_reference_time"])
                 elif self.times is not None:
-                    verif.util.warning("forecast_reference_time not found in '%s'. Using 'time' variable." % self.filename)
+                    met2verif.util.warning("forecast_reference_time not found in '%s'. Using 'time' variable." % self.filename)
                     self.forecast_reference_time = self.times[0]
                 if self.times is not None:
                     self.leadtimes = (self.times - self.forecast_reference_time) / 3600
@@ -110,135 +548,175 @@ class Netcdf(FcstInput):
             print("Could not open file '%s'. %s." % (filename, e))
             raise
 
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        # Open files cannot be sent to other processes
+        state = self.__dict__.copy()
+        state["session"] = None
+        return state
+
+    def open(self):
+        """ Opens the file and keeps it open until close() is called """
+        if self.session is None:
+            self.session = netCDF4.Dataset(self.filename, 'r')
+
+    def close(self):
+        """ Closes the file opened by open() """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    @contextlib.contextmanager
+    def open_dataset(self):
+        """ Yields the file opened by open(), or else opens the file for the duration """
+        if self.session is not None:
+            yield self.session
+        else:
+            with netCDF4.Dataset(self.filename, 'r') as file:
+                yield file
+
     @property
     def valid(self):
         """ Is this file valid? I.e. can all data be extracted from it"""
         return self.leadtimes is not None
 
-    def extract(self, lats, lons, variable, members=[0], hood=0):
+    def extract(self, lats, lons, variable, members=[0], hood=0, Itimes=None, interpolation="nearest"):
         """
         Extract forecasts from file for points. Outputs with dimensions (leadtime, location, ens)
 
+        Only the parts of the grid containing the points, and only the requested times, are
+        read from the file, such that memory usage scales with the number of points and not
+        with the size of the grid.
+
         Arguments:
             lats (np.array): Array of latitudes
             lons (np.array): Array of longitudes
             variable (str): Variable name
             members (list): Which ensemble members to use? If None, then use all
             hood (int): Neighbourhood radius
+            Itimes (list): Indices of the times to read. Other times are missing in the
+                output. If None, then read all times.
+            interpolation (str): One of "nearest", "bilinear", and "idw" (inverse distance
+                weighting). Cannot be combined with a neighbourhood.
+        """
+        return self.extract_variables(lats, lons, [variable], members, hood, Itimes, interpolation)[0]
+
+    def extract_variables(self, lats, lons, variables, members=[0], hood=0, Itimes=None, interpolation="nearest"):
+        """
+        Extract several variables for points in one pass, sharing the nearest neighbour
+        lookup and the open file. Arguments are the same as for extract(), except:
+
+        Arguments:
+            variables (list): Variable names
+
+        Returns:
+            list: One array for each variable, with dimensions (leadtime, location, ens)
         """
         if not self.valid:
             met2verif.util.error("Cannot extract data from invalid file")
 
         time_0 = time.time()
-        file = netCDF4.Dataset(self.filename, 'r')
+        interpolate = interpolation != "nearest"
+        if interpolate and hood > 0:
+            raise Exception("Neighbourhoods cannot be combined with interpolation")
+        if Itimes is None:
+            Itimes = range(len(self.leadtimes))
+        Itimes = np.unique(np.array(Itimes, int))
+
         if members is None:
             members = [0]
-            if 'ensemble_member' in file.dimensions:
-                members = range(len(file.dimensions['ensemble_member']))
+            if 'ensemble_member' in self.dimensions:
+                members = range(self.dimensions['ensemble_member'])
         member_size = len(members)
         if hood > 0:
             member_size = member_size * ((hood*2+1)**2)
-        values = np.nan * np.zeros([len(self.leadtimes), len(lats), member_size])
-        # Most time comes form this call:
-        data = file.variables[variable]
-        dims = file.variables[variable].dimensions
-        has_ens = "ensemble_member" in dims
-        has_time = "time" in dims
+
+        if interpolate:
+            """
+            Gridpoints to read for all stations, which are combined into station values by
+            one sparse matrix product for all times and members
+            """
+            II, JJ, W = self.get_weights(lats, lons, interpolation)
+        else:
+            """
+            Gridpoints to read for each station. The neighbourhood points of a station are stored
+            along the ensemble dimension, offset by offset, with all members for each offset.
+            """
+            I, J = self.get_i_j(lats, lons)
+            Ivalid = np.where((I >= 0) & (J >= 0))[0]
+            Ioffset, Joffset = np.meshgrid(range(-hood, hood + 1), range(-hood, hood + 1), indexing="ij")
+            num_offsets = Ioffset.size
+            II = (I[Ivalid][:, None] + Ioffset.flatten()[None, :]).flatten()
+            JJ = (J[Ivalid][:, None] + Joffset.flatten()[None, :]).flatten()
+
         xvar, yvar = self.get_xy()
         has_x = xvar is not None
         has_y = yvar is not None
-        assert(has_time)
-        X = 1
-        I_time = dims.index("time")
-        I_ens =None
-        if has_ens:
-            I_ens = dims.index("ensemble_member")
-        Y = 1
-        I_x = None
-        I_y = None
-        if has_x:
-            I_x = dims.index(xvar)
-            X = file.variables[variable].shape[I_x]
-        elif "longitude" in dims:
-            I_x = dims.index("longitude")
-            X = file.variables[variable].shape[I_x]
-        if has_y:
-            I_y = dims.index(yvar)
-            Y = file.variables[variable].shape[I_y]
-        elif "latitude" in dims:
-            I_y = dims.index("latitude")
-            Y = file.variables[variable].shape[I_y]
-        elif "location" in dims:
-            I_y = dims.index("location")
-            Y = file.variables[variable].shape[I_y]
-
-        # Subset by ensemble members
-        if has_ens:
-            num_members_in_file = data.shape[I_ens]
-            if np.max(members) >= num_members_in_file:
-                raise Exception("Cannot extract member %d from a %d member ensemble" % (np.max(members), num_members_in_file))
-            if members is not None and num_members_in_file > len(members):
-                Im = members
-                if I_ens == 0:
-                    data = data[Im, ...]
-                elif I_ens == 1:
-                    data = data[:, Im, ...]
-                elif I_ens == 2:
-                    data = data[:, :, Im, ...]
-                elif I_ens == 3:
-                    data = data[:, :, :, Im, ...]
-                elif I_ens == 4:
-                    data = data[:, :, :, :, Im, ...]
-
-        # Convert masked values to nan
-        np.ma.set_fill_value(data, np.nan)
-        try:
-            data = data.filled()
-        except Exception:
-            pass
 
-        """
-        Get the date into the format time, y, x, ensemble_member
-        """
-        if has_ens:
-            data = np.moveaxis(data, [I_time, I_y, I_x, I_ens], [0, 1, 2, 3])
-            if len(data.shape) == 5:
-                data = data[:, :, :, :, 0]
-        elif I_x is None:
-            data = np.moveaxis(data, [I_time, I_y], [0, 1])
-            data = np.expand_dims(data, 2)
-            data = np.expand_dims(data, 3)
-        else:
-            data = np.moveaxis(data, [I_time, I_y, I_x], [0, 1, 2])
-            if len(data.shape) == 4:
-                data = data[:, :, :, 0]
-            data = np.expand_dims(data, 3)
-
-        I, J = self.get_i_j(lats, lons)
-        Ivalid = np.where((I >= 0) & (J >= 0))[0]
-        for lt in range(len(self.leadtimes)):
-            if hood == 0:
-                values[lt, Ivalid, :] = data[lt, I[Ivalid], J[Ivalid], :]
-            else:
-                h = 0
-                for i in range(-hood, hood+1):
-                    for j in range(-hood, hood+1):
-                        # TODO: Check we are not on the edge of the domain
-                        Iens = range(len(members) * h, len(members) * (h+1))
-                        II = [I[iv] + i for iv in Ivalid]
-                        JJ = [J[iv] + j for iv in Ivalid]
-                        for e in range(len(Iens)):
-                            values[lt, Ivalid, Iens[e]] = data[lt, II, JJ, e]
-                        h += 1
+        output = list()
+        with self.open_dataset() as file:
+            for variable in variables:
+                values = np.nan * np.zeros([len(self.leadtimes), len(lats), member_size])
+                var = file.variables[variable]
+                dims = var.dimensions
+                has_ens = "ensemble_member" in dims
+                has_time = "time" in dims
+                assert(has_time)
+                I_time = dims.index("time")
+                I_ens = None
+                if has_ens:
+                    I_ens = dims.index("ensemble_member")
+                I_x = None
+                I_y = None
+                if has_x:
+                    I_x = dims.index(xvar)
+                elif "longitude" in dims:
+                    I_x = dims.index("longitude")
+                if has_y:
+                    I_y = dims.index(yvar)
+                elif "latitude" in dims:
+                    I_y = dims.index("latitude")
+                elif "location" in dims:
+                    I_y = dims.index("location")
+                if I_y is None:
+                    raise Exception("Cannot determine the spatial dimensions of '%s'" % variable)
+
+                # Subset by ensemble members
+                Imembers = None
+                if has_ens:
+                    num_members_in_file = var.shape[I_ens]
+                    if np.max(members) >= num_members_in_file:
+                        raise Exception("Cannot extract member %d from a %d member ensemble" % (np.max(members), num_members_in_file))
+                    Imembers = list(members)
+
+                # Read all neighbourhood points at once. Points outside the domain are missing.
+                curr = read_points(var, I_time, I_y, I_x, I_ens, II, JJ, Imembers, Itimes)
+                if interpolate:
+                    curr = apply_weights(W, curr)
+                    values[Itimes] = np.broadcast_to(curr, [len(Itimes), len(lats), member_size])
+                else:
+                    curr = curr.reshape([len(Itimes), len(Ivalid), num_offsets, curr.shape[2]])
+                    curr = np.broadcast_to(curr, [len(Itimes), len(Ivalid), num_offsets, len(members)])
+                    values[np.ix_(Itimes, Ivalid)] = curr.reshape([len(Itimes), len(Ivalid), member_size])
+                output += [values]
         print("Getting values %.2f" % (time.time() - time_0))
 
-        file.close()
-        return values
+        return output
 
     def get_i_j(self, lats, lons):
         """
             Finds the nearest neighbour in the file's grid for a list of lookup points
 
+            Lookups are cached in memory for the rest of the run, and on disk if the
+            object was created with a cache directory, such that files on the same grid
+            only need to be looked up once.
+
             Arguments:
                 lats (list): Latitudes
                 lons (list): Longitudes
@@ -246,95 +724,126 @@ class Netcdf(FcstInput):
                 I (list): I indices, -1 if outside domain
                 J (list): J indices, -1 if outside domain
         """
-        with netCDF4.Dataset(self.filename, 'r') as file:
-            Npoints = len(lats)
-            xvar, yvar = self.get_xy()
-
-            proj = None
-            is_regular_grid = False
-            for v in file.variables:
-                if hasattr(file.variables[v], "proj4"):
-                    projection = str(file.variables[v].proj4)
-                    proj = pyproj.Proj(projection)
-                    print(projection)
-                    if projection == "+proj=longlat +a=6367470 +e=0 +no_defs":
-                        is_regular_grid = True
-            I = list()
-            J = list()
-            if is_regular_grid:
-                if "latitude" in file.variables:
-                    ilats = file.variables["latitude"][:]
-                    ilons = file.variables["longitude"][:]
-                elif "lat" in file.variables:
-                    ilats = file.variables["lat"][:]
-                    ilons = file.variables["lon"][:]
-                else:
-                    met2verif.util.error("Cannot determine latitude and longitude")
-                # TODO: This assumes that latitude is before longitude in the dimensions of a variable
-                for i in range(Npoints):
-                    currlat = lats[i]
-                    currlon = lons[i]
-                    I += [np.argmin(np.abs(currlat - ilats))]
-                    J += [np.argmin(np.abs(currlon - ilons))]
-                print(I, J)
-            elif proj is not None and xvar is not None and yvar is not None:
-                x = file.variables[xvar][:]
-                y = file.variables[yvar][:]
-
-                # Project lat lon onto grid projection
-                xx, yy = proj(lons, lats)
-                Ix = np.argsort(x)
-                Iy = np.argsort(y)
-                IIx = np.argsort(Ix)
-                IIy = np.argsort(Iy)
-                J = [IIx[int(xxx)] for xxx in np.round(np.interp(xx, x[Ix], range(len(x)), 0, len(x) - 1))]
-                I = [IIy[int(yyy)] for yyy in np.round(np.interp(yy, y[Iy], range(len(y)), 0, len(y) - 1))]
-            else:
-                print("Could not find projection. Computing nearest neighbour from lat/lon.")
-                # Find lat and lons
-                if "latitude" in file.variables:
-                    ilats = file.variables["latitude"][:]
-                    ilons = file.variables["longitude"][:]
-                elif "lat" in file.variables:
-                    ilats = file.variables["lat"][:]
-                    ilons = file.variables["lon"][:]
-                else:
-                    met2verif.util.error("Cannot determine latitude and longitude")
-
-                if len(ilats.shape) == 1:
-                    # Global lat/lon data
-                    ilons, ilats = np.meshgrid(ilons, ilats)
-
-                for i in range(Npoints):
-                    currlat = lats[i]
-                    currlon = lons[i]
-                    dist = met2verif.util.distance(currlat, currlon, ilats, ilons)
-                    indices = np.unravel_index(dist.argmin(), dist.shape)
-                    I += [indices[0]]
-                    if len(indices) == 2:
-                        J += [indices[1]]
-                    else:
-                        J += [0]
-        return np.array(I, int), np.array(J, int)
+        with self.open_dataset() as file:
+            grid = self.get_grid(file)
+
+        key = get_grid_key(grid, lats, lons)
+        if key in _index_cache:
+            return _index_cache[key]
+
+        cache_filename = None
+        if self.cache_dir is not None:
+            cache_filename = os.path.join(self.cache_dir, "%s.npz" % key)
+            if os.path.exists(cache_filename):
+                try:
+                    with np.load(cache_filename) as cached:
+                        I, J = cached["I"], cached["J"]
+                    _index_cache[key] = (I, J)
+                    return I, J
+                except Exception as e:
+                    met2verif.util.warning("Could not read cache file '%s'. %s." % (cache_filename, e))
+
+        I, J = compute_i_j(grid, lats, lons)
+        _index_cache[key] = (I, J)
+
+        if cache_filename is not None:
+            try:
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                np.savez(cache_filename, I=I, J=J)
+            except Exception as e:
+                met2verif.util.warning("Could not write cache file '%s'. %s." % (cache_filename, e))
+        return I, J
+
+    def get_weights(self, lats, lons, method):
+        """
+            Computes interpolation weights from the file's grid to a list of lookup points.
+            Weights are cached in memory for the rest of the run.
+
+            Arguments:
+                lats (list): Latitudes
+                lons (list): Longitudes
+                method (str): One of "bilinear" and "idw"
+            Returns:
+                I (np.array): Row index of each gridpoint used
+                J (np.array): Column index of each gridpoint used
+                W (scipy.sparse.csr_matrix): Weights with dimensions (lookup point, gridpoint used)
+        """
+        with self.open_dataset() as file:
+            grid = self.get_grid(file)
+
+        key = "%s-%s" % (get_grid_key(grid, lats, lons), method)
+        if key not in _index_cache:
+            _index_cache[key] = compute_weights(grid, lats, lons, method)
+        return _index_cache[key]
+
+    def get_grid(self, file):
+        """
+            Reads the coordinates needed to look up points in the file's grid. The result
+            is not kept on the object, since the coordinates of every input would otherwise
+            stay in memory. Lookups are cached by get_grid_key instead.
+
+            Arguments:
+                file (netCDF4.Dataset): The opened file
+            Returns:
+                dict: Grid description with keys "type" (one of "regular", "projected",
+                    "latlon"), "projection", "x", "y", "lats", and "lons". Unused
+                    coordinates are None.
+        """
+        xvar, yvar = self.get_xy()
+
+        grid = {"type": None, "projection": None, "x": None, "y": None, "lats": None, "lons": None}
+        is_regular_grid = False
+        for v in file.variables:
+            if hasattr(file.variables[v], "proj4"):
+                projection = str(file.variables[v].proj4)
+                grid["projection"] = projection
+                print(projection)
+                is_regular_grid = met2verif.util.proj4_string_to_dict(projection).get("+proj") in ["longlat", "latlong", "lonlat", "latlon"]
+        if is_regular_grid and self.has_1d_lat_lon(file):
+            grid["type"] = "regular"
+        elif grid["projection"] is not None and xvar is not None and yvar is not None:
+            grid["type"] = "projected"
+            grid["x"] = file.variables[xvar][:]
+            grid["y"] = file.variables[yvar][:]
+            return grid
+        else:
+            grid["type"] = "latlon"
+
+        if "latitude" in file.variables:
+            grid["lats"] = file.variables["latitude"][:]
+            grid["lons"] = file.variables["longitude"][:]
+        elif "lat" in file.variables:
+            grid["lats"] = file.variables["lat"][:]
+            grid["lons"] = file.variables["lon"][:]
+        else:
+            met2verif.util.error("Cannot determine latitude and longitude")
+        return grid
+
+    def has_1d_lat_lon(self, file):
+        """ Does the file have latitude and longitude as separate 1D coordinates? """
+        for latvar, lonvar in [("latitude", "longitude"), ("lat", "lon")]:
+            if latvar in file.variables and lonvar in file.variables:
+                return len(file.variables[latvar].shape) == 1 and len(file.variables[lonvar].shape) == 1
+        return False
 
     def get_xy(self):
-        file = netCDF4.Dataset(self.filename, 'r')
+        dimensions = self.dimensions
         xvar = None
         yvar = None
-        if "x" in file.dimensions and "y" in file.dimensions:
+        if "x" in dimensions and "y" in dimensions:
             xvar = "x"
             yvar = "y"
-        elif "X" in file.dimensions and "Y" in file.dimensions:
+        elif "X" in dimensions and "Y" in dimensions:
             xvar = "X"
             yvar = "Y"
-        elif "Xc" in file.dimensions and "Yc" in file.dimensions:
+        elif "Xc" in dimensions and "Yc" in dimensions:
             xvar = "Xc"
             yvar = "Yc"
-        elif "lat" in file.dimensions and "lon" in file.dimensions:
+        elif "lat" in dimensions and "lon" in dimensions:
             xvar = "lon"
             yvar = "lat"
-        elif "latitude" in file.dimensions and "longitude" in file.dimensions:
+        elif "latitude" in dimensions and "longitude" in dimensions:
             xvar = "longitude"
             yvar = "latitude"
-        file.close()
         return xvar, yvar
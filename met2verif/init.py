@@ -5,11 +5,8 @@ import netCDF4
 import numpy as np
 import os
 import sys
-import met2verif.obsinput
-import met2verif.fcstinput
+import uuid
 import met2verif.locinput
-import met2verif.addfcst
-import met2verif.addobs
 
 
 def add_subparser(parser):
@@ -81,6 +78,8 @@ def run(parser, argv=sys.argv[1:]):
         file.x0 = args.x0
     if args.x1:
         file.x1 = args.x1
+    # Lets ledgers tell a re-created file apart from the old one
+    file.uuid = str(uuid.uuid4())
 
     L = len(locations)
     lats = np.zeros(L, 'float')
@@ -0,0 +1,113 @@
+import hashlib
+import netCDF4
+import numpy as np
+import os
+import sqlite3
+
+
+def get_options_hash(args):
+    """ Computes a fingerprint of the command-line options that affect the values written
+
+    Arguments:
+        args (argparse.Namespace): Parsed command-line arguments
+
+    Returns:
+        str: Hexadecimal digest
+    """
+    # Options that only affect how the run is carried out, or that are handled separately
+    ignore = ["files", "verif_file", "ledger", "clear", "overwrite", "sort", "debug", "sync_frequency",
+              "num_processes", "prefetch", "cache_dir"]
+    options = [(key, value) for key, value in sorted(vars(args).items()) if key not in ignore]
+    return hashlib.sha1(repr(options).encode("utf-8")).hexdigest()
+
+
+def get_verif_identity(verif_file):
+    """ Computes a fingerprint of a verif file that changes when the file is re-created
+
+    The fingerprint covers the locations and leadtimes, and the uuid attribute written by
+    met2verif init, but not the data, such that adding inputs does not change it.
+
+    Arguments:
+        verif_file (str): Verif file
+
+    Returns:
+        str: Hexadecimal digest, or an empty string if the file cannot be read
+    """
+    try:
+        file = netCDF4.Dataset(verif_file, 'r')
+    except (OSError, RuntimeError):
+        return ""
+    try:
+        digest = hashlib.sha1()
+        for name in ["location", "leadtime"]:
+            if name in file.variables:
+                digest.update(name.encode("utf-8"))
+                digest.update(np.ascontiguousarray(file.variables[name][:], np.float64).tobytes())
+        if hasattr(file, "uuid"):
+            digest.update(str(file.uuid).encode("utf-8"))
+        return digest.hexdigest()
+    finally:
+        file.close()
+
+
+class Ledger(object):
+    """
+    Records which input files have been added to a variable in a verif file, in an SQLite
+    file, such that later runs can skip files that have not changed since. Files are
+    identified by path, size, and modification time, so checking a file only needs os.stat.
+    Entries are also tied to the identity of the verif file (see get_verif_identity), such
+    that files are added again when the verif file is re-created.
+    """
+    def __init__(self, filename, verif_file, variable, options):
+        """
+        Arguments:
+            filename (str): SQLite file, created if it does not exist
+            verif_file (str): Verif file the inputs are added to
+            variable (str): Variable in the verif file the inputs are added to
+            options (str): Fingerprint of the options used (see get_options_hash). Files
+                added with other options are not skipped.
+        """
+        self.verif_file = os.path.abspath(verif_file)
+        self.identity = get_verif_identity(verif_file)
+        self.variable = variable
+        self.options = options
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS ingested (verif_file TEXT, variable TEXT, "
+                                "path TEXT, size INTEGER, mtime INTEGER, options TEXT, identity TEXT, "
+                                "PRIMARY KEY (verif_file, variable, path))")
+        self.connection.commit()
+
+    def get_stat(self, path):
+        """ Returns the absolute path, size, and modification time (ns) of a file """
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def has(self, path):
+        """ Has this file, unchanged, been added to the same verif file with the same options before? """
+        try:
+            path, size, mtime = self.get_stat(path)
+        except OSError:
+            return False
+        cursor = self.connection.execute("SELECT size, mtime, options, identity FROM ingested WHERE verif_file=? AND variable=? AND path=?",
+                                         (self.verif_file, self.variable, path))
+        row = cursor.fetchone()
+        return row is not None and tuple(row) == (size, mtime, self.options, self.identity)
+
+    def add(self, paths):
+        """ Records that files have been added """
+        rows = list()
+        for path in paths:
+            try:
+                rows += [(self.verif_file, self.variable) + self.get_stat(path) + (self.options, self.identity)]
+            except OSError:
+                continue
+        self.connection.executemany("INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    def clear(self):
+        """ Forgets all files added to the variable """
+        self.connection.execute("DELETE FROM ingested WHERE verif_file=? AND variable=?", (self.verif_file, self.variable))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -5,10 +5,10 @@ import netCDF4
 
 
 import met2verif.util
-import verif.input
 
 
 def get(filename):
+    import verif.input
     _stderr = sys.stderr
     _stdout = sys.stdout
     try:
@@ -53,6 +53,7 @@ class Verif(LocInput):
         self.filename = filename
 
     def read(self):
+        import verif.input
         file = verif.input.get_input(self.filename)
         locations = dict()
         for location in file.locations:
@@ -1,27 +1,143 @@
+import hashlib
+import io
+import itertools
 import met2verif.util
+import netCDF4
 import numpy as np
+import os
+import re
+import tempfile
 
 
-def get(filename):
+def get(filename, cache_dir=None, locations=None, max_distance=1000):
+    """ Returns an ObsInput for the file, based on its format
+
+    Arguments:
+        filename (str): Observation file
+        cache_dir (str): Directory where parsed text files are cached (see ObsInput)
+        locations (dict): Locations that observations without station ids are matched to
+            (see Titan)
+        max_distance (float): Maximum distance (m) when matching observations to locations
+    """
+    file = open(filename, 'rb')
+    magic = file.read(4)
+    file.close()
+    # NetCDF 3 files start with "CDF", and NetCDF 4 files with the HDF5 signature
+    if magic[0:3] == b"CDF" or magic == b"\x89HDF":
+        return Netcdf(filename)
+
     file = open(filename, 'r')
     header = file.readline()
     file.close()
     if len(header) > 5:
         if header[0:5] == " Stnr":
-            return Kdvh(filename)
+            return Kdvh(filename, cache_dir=cache_dir)
         elif header[0:2] == "id":
-            return Text(filename)
+            return Text(filename, cache_dir=cache_dir)
         else:
-            words = header.split(';')
+            words = header.strip().split(';')
             if "lat" in words:
-                return Titan(filename)
+                return Titan(filename, locations, max_distance)
             else:
                 raise NotImplementedError
     else:
         raise NotImplementedError
 
 
+def read_blocks(ifile, block_size=100000):
+    """ Reads the remaining lines of a file in blocks
+
+    Yields:
+        list: Up to block_size lines
+    """
+    while True:
+        lines = list(itertools.islice(ifile, block_size))
+        if len(lines) == 0:
+            return
+        yield lines
+
+
+def load_columns(lines, delimiter, columns):
+    """ Parses columns of numbers from lines of text with np.loadtxt
+
+    The missing value markers '.' and 'x' become nan. Empty lines are skipped.
+
+    Arguments:
+        lines (list): Lines of text
+        delimiter (str): Column delimiter, None for any whitespace
+        columns (list): Which columns to read
+
+    Returns:
+        np.array: 2D array (line, column)
+
+    Raises:
+        ValueError: If any line cannot be parsed
+    """
+    text = ''.join(lines)
+    if text.strip() == '':
+        return np.zeros([0, len(columns)])
+    if text[-1] != '\n':
+        text += '\n'
+    # Markers in the first column are not replaced, but then the line is invalid anyway
+    separator = ' ' if delimiter is None else delimiter
+    text = re.sub(r'%s[.x](?=[%s\n])' % (re.escape(separator), re.escape(separator)), separator + 'nan', text)
+    try:
+        return np.loadtxt(io.StringIO(text), delimiter=delimiter, usecols=columns, comments=None, ndmin=2)
+    except IndexError as e:
+        raise ValueError(str(e))
+
+
+def parse_value(raw):
+    """ Converts a value from a text file to float, with the missing value markers '.' and 'x' as nan """
+    if(raw == '.'):
+        return np.nan
+    elif(raw == 'x'):
+        return np.nan
+    return float(raw)
+
+
+def check_integer(values):
+    """ Raises ValueError if any value is not an integer """
+    if not np.isfinite(values).all() or (np.mod(values, 1) != 0).any():
+        raise ValueError("Expected integers")
+
+
+def concatenate(data):
+    """ Joins the output of several parsed blocks into one dictionary """
+    if len(data) == 0:
+        return {"times": np.zeros(0, int), "ids": np.zeros(0, int), "obs": np.zeros(0)}
+    return {key: np.concatenate([curr[key] for curr in data]) for key in data[0]}
+
+
+def get_nearest(data):
+    """ Keeps the observation with the smallest distance for each time and id
+
+    Arguments:
+        data (dict): times, ids, obs, and dist arrays. Of equally near observations, the
+            last is kept, as when observations are placed in a verif file.
+
+    Returns:
+        dict: The same keys, with one observation for each time and id
+    """
+    position = np.arange(len(data["obs"]))
+    Isorted = np.lexsort((-position, data["dist"], data["ids"], data["times"]))
+    times = data["times"][Isorted]
+    ids = data["ids"][Isorted]
+    is_first = np.ones(len(Isorted), bool)
+    is_first[1:] = (times[1:] != times[:-1]) | (ids[1:] != ids[:-1])
+    I = Isorted[is_first]
+    return {key: value[I] for key, value in data.items()}
+
+
 class ObsInput(object):
+    """
+    Text formats can optionally be cached in a directory. The first read parses all variables
+    in the file and stores them as arrays in a .npz file, such that later reads of any
+    variable load the arrays instead of parsing the text. Cache files are identified by the
+    path, size, and modification time of the input file.
+    """
+    cache_dir = None
+
     def read(self, variable):
         """
         Arguments:
@@ -33,32 +149,171 @@ class ObsInput(object):
             lons (np.array):
             obs (np.array):
         """
+        return concatenate(list(self.read_chunks(variable)))
+
+    def read_chunks(self, variable, chunk_size=100000):
+        """ Reads the file in parts, such that large files can be processed with limited memory
+
+        Arguments:
+            variable (str): Variable to load
+            chunk_size (int): Maximum number of lines (or records) in each part
+
+        Yields:
+            dict: Same as read(), for one part of the file
+        """
+        if self.cache_dir is not None:
+            cache = self.load_cache(variable)
+            if cache is None:
+                cache = self.write_cache()
+            if cache is not None:
+                if variable not in cache["variables"]:
+                    raise ValueError("Variable '%s' is not in %s" % (variable, self.filename))
+                values = cache["values_%d" % cache["variables"].index(variable)]
+                Ivalid = np.where(~np.isnan(values))[0]
+                for start in range(0, len(Ivalid), chunk_size):
+                    I = Ivalid[start:start + chunk_size]
+                    yield {"times": cache["times"][I], "ids": cache["ids"][I], "obs": values[I]}
+                return
+
+        for data in self.parse_chunks([variable], chunk_size):
+            yield {"times": data["times"], "ids": data["ids"], "obs": data["obs"][:, 0]}
+
+    def get_variables(self):
+        """ Returns the names of all variables in the file """
+        raise NotImplementedError
+
+    def parse_chunks(self, variables, chunk_size=100000):
+        """ Parses the file in parts
+
+        Arguments:
+            variables (list): Variables to load
+            chunk_size (int): Maximum number of lines in each part
+
+        Yields:
+            dict: times, ids, and obs (2D array with one column for each variable), for
+                the lines where at least one of the variables is not missing
+        """
         raise NotImplementedError
 
+    def get_cache_filename(self):
+        stat = os.stat(self.filename)
+        key = "%s;%d;%d" % (os.path.abspath(self.filename), stat.st_size, stat.st_mtime_ns)
+        return os.path.join(self.cache_dir, "obs_%s.npz" % hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def load_cache(self, variable):
+        """ Returns the cached arrays for the file, or None if they are not cached
+
+        Only the times, ids, and the values of one variable are loaded from the cache file.
+
+        Arguments:
+            variable (str): Variable to load
+
+        Returns:
+            dict: Same keys as from write_cache, but with values_%d only for this variable
+        """
+        filename = self.get_cache_filename()
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename) as cached:
+                cache = {key: cached[key] for key in ["variables", "times", "ids"]}
+                cache["variables"] = cache["variables"].tolist()
+                if variable in cache["variables"]:
+                    key = "values_%d" % cache["variables"].index(variable)
+                    cache[key] = cached[key]
+            return cache
+        except Exception as e:
+            met2verif.util.warning("Could not read cache file '%s'. %s." % (filename, e))
+            return None
+
+    def write_cache(self):
+        """ Parses all variables in the file and writes them to the cache
+
+        Returns:
+            dict: The cached arrays, or None if the file could not be cached
+        """
+        filename = self.get_cache_filename()
+        try:
+            variables = self.get_variables()
+            data = concatenate(list(self.parse_chunks(variables)))
+            if len(data["obs"]) == 0:
+                data["obs"] = np.zeros([0, len(variables)])
+            cache = {"times": data["times"], "ids": data["ids"], "variables": variables}
+            for i in range(len(variables)):
+                cache["values_%d" % i] = data["obs"][:, i]
+        except Exception as e:
+            met2verif.util.warning("Could not cache %s. %s." % (self.filename, e))
+            return None
+
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Write to a temporary file first, such that other processes never see a partial file
+            fd, temp_filename = tempfile.mkstemp(suffix=".npz", dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as file:
+                np.savez(file, **cache)
+            os.replace(temp_filename, filename)
+        except Exception as e:
+            met2verif.util.warning("Could not write cache file '%s'. %s." % (filename, e))
+        return cache
+
 
 class Text(ObsInput):
-    def __init__(self, filename):
+    def __init__(self, filename, cache_dir=None):
         self.filename = filename
+        self.cache_dir = cache_dir
 
-    def read(self, variable):
-        ifile = open(self.filename, 'r')
+    @staticmethod
+    def read_header(ifile):
         header = ifile.readline().replace('\n', '').split(';')
-        header = [i for i in header if i is not '']
+        return [i for i in header if i != '']
+
+    def get_variables(self):
+        with open(self.filename, 'r') as ifile:
+            header = self.read_header(ifile)
+        return [name for name in header if name not in ["id", "date", "hour"]]
+
+    def parse_chunks(self, variables, chunk_size=100000):
+        ifile = open(self.filename, 'r')
+        header = self.read_header(ifile)
         Iid = header.index("id")
         Idate = header.index("date")
         Ihour = header.index("hour")
-        Ivar = header.index(variable)
-        if None in [Iid, Idate, Ihour, Ivar]:
-            print("The header in %s is invalid:" % ifilename)
+        Ivars = [header.index(variable) for variable in variables]
+        if None in [Iid, Idate, Ihour] + Ivars:
+            print("The header in %s is invalid:" % self.filename)
             print(header)
             ifile.close()
-            return {}
+            return
+
+        for lines in read_blocks(ifile, chunk_size):
+            try:
+                data = self.parse_block(lines, Iid, Idate, Ihour, Ivars)
+            except ValueError:
+                data = self.parse_lines(lines, Iid, Idate, Ihour, Ivars)
+            yield data
+        ifile.close()
+
+    def parse_block(self, lines, Iid, Idate, Ihour, Ivars):
+        """ Parses lines in bulk. Raises ValueError if any line is not in the expected format. """
+        values = load_columns(lines, ';', [0, Iid, Idate, Ihour] + Ivars)
+        ids, dates, hours = [values[:, i] for i in range(1, 4)]
+        obs = values[:, 4:]
+        for column in [ids, dates, hours]:
+            check_integer(column)
+        Ivalid = np.where(~np.isnan(obs).all(axis=1))[0]
+        ids = ids[Ivalid].astype(int)
+        times = met2verif.util.dates_to_unixtime(dates[Ivalid].astype(int)) + hours[Ivalid].astype(int) * 3600
+        return {"times": np.array(times, int), "ids": ids, "obs": obs[Ivalid, :]}
+
+    def parse_lines(self, lines, Iid, Idate, Ihour, Ivars):
+        """ Parses lines one at a time, skipping lines that are not in the expected format """
         times = list()
         obs = list()
         ids = list()
 
         date2unixtime_map = dict()  # Lookup table for converting date to unixtime
-        for line in ifile:
+        for line in lines:
             data = line.strip().split(';')
             if len(data) > 1 and met2verif.util.is_number(data[0]):
                 try:
@@ -69,14 +324,8 @@ class Text(ObsInput):
                     print("Could not read the following:")
                     print(data)
                     continue
-                raw = data[Ivar]
-                if(raw == '.'):
-                    value = np.nan
-                elif(raw == 'x'):
-                    value = np.nan
-                else:
-                    value = float(data[Ivar])
-                if not np.isnan(value):
+                values = [parse_value(data[Ivar]) for Ivar in Ivars]
+                if not np.isnan(values).all():
                     if date not in date2unixtime_map:
                         ut = met2verif.util.date_to_unixtime(date)
                         date2unixtime_map[date] = ut
@@ -84,38 +333,84 @@ class Text(ObsInput):
                         ut = date2unixtime_map[date]
                     times += [ut + time*3600]
                     ids += [id]
-                    obs += [value]
+                    obs += [values]
 
-        data = {"times": np.array(times, int), "ids": np.array(ids, int), "obs": np.array(obs)}
+        data = {"times": np.array(times, int), "ids": np.array(ids, int), "obs": np.reshape(obs, [len(obs), len(Ivars)])}
         return data
 
 
 class Kdvh(ObsInput):
-    def __init__(self, filename, locations_file=None):
+    def __init__(self, filename, locations_file=None, cache_dir=None):
         self.filename = filename
+        self.cache_dir = cache_dir
 
-    def read(self, variable):
-        ifile = open(self.filename, 'r')
+    @staticmethod
+    def read_header(ifile):
         header = ifile.readline().replace('\n', '').split(' ')
-        header = [i for i in header if i is not '']
+        return [i for i in header if i != '']
+
+    def get_variables(self):
+        with open(self.filename, 'r') as ifile:
+            header = self.read_header(ifile)
+        return [name for name in header if name not in ["Stnr", "Year", "Month", "Day", "Time(UTC)", "MIN"]]
+
+    def parse_chunks(self, variables, chunk_size=100000):
+        ifile = open(self.filename, 'r')
+        header = self.read_header(ifile)
         Iid = header.index("Stnr")
         Iyear = header.index("Year")
         Imonth = header.index("Month")
         Iday = header.index("Day")
         Itime = header.index("Time(UTC)")
         Imin = header.index("MIN") if "MIN" in header else None
-        Ivar = header.index(variable)
-        if None in [Iid, Iyear, Imonth, Iday, Itime, Ivar]:
-            print("The header in %s is invalid:" % ifilename)
+        Ivars = [header.index(variable) for variable in variables]
+        if None in [Iid, Iyear, Imonth, Iday, Itime] + Ivars:
+            print("The header in %s is invalid:" % self.filename)
             print(header)
             ifile.close()
-            return {}
+            return
+
+        columns = [Iid, Iyear, Imonth, Iday, Itime, Imin, Ivars]
+        for lines in read_blocks(ifile, chunk_size):
+            try:
+                data = self.parse_block(lines, *columns)
+            except ValueError:
+                data = self.parse_lines(lines, *columns)
+            yield data
+        ifile.close()
+
+    def parse_block(self, lines, Iid, Iyear, Imonth, Iday, Itime, Imin, Ivars):
+        """ Parses lines in bulk. Raises ValueError if any line is not in the expected format. """
+        columns = [0, Iid, Iyear, Imonth, Iday, Itime]
+        if Imin is not None:
+            columns += [Imin]
+        values = load_columns(lines, None, columns + Ivars)
+        ids, years, months, days, hours = [values[:, i] for i in range(1, 6)]
+        obs = values[:, len(columns):]
+        for column in [ids, years, months, days, hours]:
+            check_integer(column)
+        Ivalid = np.where(~np.isnan(obs).all(axis=1))[0]
+        dates = years[Ivalid].astype(int) * 10000 + months[Ivalid].astype(int) * 100 + days[Ivalid].astype(int)
+        ut = met2verif.util.dates_to_unixtime(dates)
+        hours = hours[Ivalid].astype(int)
+        if Imin is not None:
+            minutes = values[Ivalid, 6]
+            if not np.isfinite(minutes).all():
+                raise ValueError("Invalid minutes")
+            # Use the same floating point operations as parse_lines, including the truncation
+            times = (ut + (hours + minutes / 60.0) * 3600).astype(int)
+        else:
+            times = ut + hours * 3600
+        return {"times": np.array(times, int), "ids": ids[Ivalid].astype(int), "obs": obs[Ivalid, :]}
+
+    def parse_lines(self, lines, Iid, Iyear, Imonth, Iday, Itime, Imin, Ivars):
+        """ Parses lines one at a time, skipping lines that are not in the expected format """
         times = list()
         obs = list()
         ids = list()
 
         date2unixtime_map = dict()  # Lookup table for converting date to unixtime
-        for line in ifile:
+        for line in lines:
             data = line.strip().split(' ')
             data = [i for i in data if i is not '']
             if len(data) > 1 and met2verif.util.is_number(data[0]):
@@ -131,14 +426,8 @@ class Kdvh(ObsInput):
                 if Imin is not None:
                     min = float(data[Imin])
                     time = time + min / 60.0
-                raw = data[Ivar]
-                if(raw == '.'):
-                    value = np.nan
-                elif(raw == 'x'):
-                    value = np.nan
-                else:
-                    value = float(data[Ivar])
-                if not np.isnan(value):
+                values = [parse_value(data[Ivar]) for Ivar in Ivars]
+                if not np.isnan(values).all():
                     if date not in date2unixtime_map:
                         ut = met2verif.util.date_to_unixtime(date)
                         date2unixtime_map[date] = ut
@@ -146,29 +435,186 @@ class Kdvh(ObsInput):
                         ut = date2unixtime_map[date]
                     times += [ut + time*3600]
                     ids += [id]
-                    obs += [value]
+                    obs += [values]
 
-        data = {"times": np.array(times, int), "ids": np.array(ids, int), "obs": np.array(obs)}
+        data = {"times": np.array(times, int), "ids": np.array(ids, int), "obs": np.reshape(obs, [len(obs), len(Ivars)])}
         return data
 
 
-class Titan(ObsInput):
+class Netcdf(ObsInput):
+    """
+    Observations in a NetCDF file, either as a 2D array with time and location dimensions
+    (e.g. TA(time, location)) or as a list of points (e.g. TA(obs)). In both cases, the
+    variable time has the time of each index of the time dimension (or point), and the
+    station ids are in the variable location (or station_id or id). Time is converted from
+    the units attribute if it has one, and is otherwise assumed to be in unixtime.
+
+    The file is read a number of times at a time, without any work per observation in
+    Python. NetCDF files are not cached, since they are already in binary form.
+    """
     def __init__(self, filename):
         self.filename = filename
 
-    def read(self, variable):
+    def read_chunks(self, variable, chunk_size=100000):
+        file = netCDF4.Dataset(self.filename, 'r')
+        try:
+            if variable not in file.variables:
+                raise ValueError("Variable '%s' is not in %s" % (variable, self.filename))
+            ncvar = file.variables[variable]
+            nctime = file.variables["time"]
+            ncid = None
+            for name in ["location", "station_id", "id"]:
+                if name in file.variables:
+                    ncid = file.variables[name]
+                    break
+            if ncid is None:
+                raise ValueError("Could not find station ids in %s" % self.filename)
+            if len(nctime.dimensions) != 1 or len(ncid.dimensions) != 1:
+                raise ValueError("Time and station ids must be one dimensional in %s" % self.filename)
+
+            time_dim = nctime.dimensions[0]
+            location_dim = ncid.dimensions[0]
+            if time_dim == location_dim and ncvar.dimensions == (time_dim,):
+                """ List of points """
+                for start in range(0, ncvar.shape[0], chunk_size):
+                    end = start + chunk_size
+                    yield get_valid(get_times(nctime, start, end), np.array(ncid[start:end], int), ncvar[start:end])
+            elif len(ncvar.dimensions) == 2 and set(ncvar.dimensions) == set([time_dim, location_dim]):
+                """ Time and location dimensions """
+                ids = np.array(ncid[:], int)
+                num_times = nctime.shape[0]
+                time_axis = ncvar.dimensions.index(time_dim)
+                times_per_chunk = max(1, chunk_size // max(1, len(ids)))
+                for start in range(0, num_times, times_per_chunk):
+                    end = min(start + times_per_chunk, num_times)
+                    if time_axis == 0:
+                        values = ncvar[start:end, :]
+                    else:
+                        values = ncvar[:, start:end].T
+                    times = get_times(nctime, start, end)
+                    times, curr_ids = np.meshgrid(times, ids, indexing="ij")
+                    yield get_valid(times.flatten(), curr_ids.flatten(), values.flatten())
+            else:
+                raise ValueError("Variable '%s' in %s does not have time and location dimensions" % (variable, self.filename))
+        finally:
+            file.close()
+
+
+def get_times(nctime, start, end):
+    """ Reads times from a NetCDF variable and converts them to unixtime """
+    times = np.array(nctime[start:end])
+    if hasattr(nctime, "units"):
+        return met2verif.util.convert_time(times, nctime.units, getattr(nctime, "calendar", "standard"))
+    return np.array(times, int)
+
+
+def get_valid(times, ids, values):
+    """ Returns the observations (same as ObsInput.read) that are not missing """
+    values = np.ma.filled(np.ma.array(values, dtype=float), np.nan)
+    Ivalid = np.where(~np.isnan(values))[0]
+    return {"times": np.array(times, int)[Ivalid], "ids": np.array(ids, int)[Ivalid], "obs": values[Ivalid]}
+
+
+class Titan(ObsInput):
+    """
+    Observations from Titan, separated by ';', with the position of each observation in the
+    columns lat and lon instead of a station id. Observations are matched to the nearest
+    location within max_distance, and others are discarded. If several observations are
+    matched to the same location and time, the nearest one is used.
+
+    The time is taken from the column time (unixtime) if it exists, and otherwise from the
+    first YYYYMMDDHH or YYYYMMDDTHH in the filename. The observations are in the column with
+    the variable name, or in the column value. If the column dqc exists, only observations
+    that passed the quality control (dqc = 0) are used.
+    """
+    def __init__(self, filename, locations=None, max_distance=1000):
+        """
+        Arguments:
+            filename (str): Titan file
+            locations (dict): id -> {"lat", "lon", ...} of the locations to match to
+            max_distance (float): Maximum distance (m) between an observation and its location
+        """
+        self.filename = filename
+        self.locations = locations
+        self.max_distance = max_distance
+
+    @staticmethod
+    def read_header(ifile):
+        header = ifile.readline().strip().split(';')
+        return [i for i in header if i != '']
+
+    def get_file_time(self):
+        """ Returns the time from the filename in unixtime """
+        match = re.search(r'(\d{8})T?(\d{2})', os.path.basename(self.filename))
+        if match is None:
+            raise ValueError("Could not find the time in the filename of %s" % self.filename)
+        return met2verif.util.date_to_unixtime(int(match.group(1))) + int(match.group(2)) * 3600
+
+    def read_chunks(self, variable, chunk_size=100000):
+        """ Reads the file in parts and matches each part to the locations
+
+        Since the nearest observation of each location and time can be in any part of the
+        file, the matched observations are kept until the whole file is read and are then
+        yielded as one chunk. This is at most one observation per location and time.
+        """
+        import scipy.spatial
+        if self.locations is None or len(self.locations) == 0:
+            raise ValueError("Locations are needed to match observations in %s" % self.filename)
+        ids = np.array(list(self.locations.keys()), int)
+        lats = np.array([self.locations[id]["lat"] for id in ids], float)
+        lons = np.array([self.locations[id]["lon"] for id in ids], float)
+        tree = scipy.spatial.cKDTree(met2verif.util.lat_lon_to_xyz(lats, lons))
+
         ifile = open(self.filename, 'r')
-        header = ifile.readline().replace('\n', '').split(' ')
-        header = [i for i in header if i is not '']
+        header = self.read_header(ifile)
         Ilat = header.index("lat")
         Ilon = header.index("lon")
-        Ielev = header.index("elev")
-        Ivar = header.index("value")
-        if None in [Ilat, Ilon, Ielev, Ivar]:
-            print("The header in %s is invalid:" % ifilename)
-            print(header)
-            ifile.close()
-            return {}
-        times = list()
-        obs = list()
-        ids = list()
+        Ivar = header.index(variable) if variable in header else header.index("value")
+        Itime = header.index("time") if "time" in header else None
+        Idqc = header.index("dqc") if "dqc" in header else None
+        file_time = None
+        if Itime is None:
+            file_time = self.get_file_time()
+        columns = [I for I in [Ilat, Ilon, Ivar, Itime, Idqc] if I is not None]
+
+        matched = {"times": np.zeros(0, int), "ids": np.zeros(0, int), "obs": np.zeros(0), "dist": np.zeros(0)}
+        for lines in read_blocks(ifile, chunk_size):
+            try:
+                values = load_columns(lines, ';', columns)
+            except ValueError:
+                values = self.parse_lines(lines, columns)
+            curr_lats, curr_lons, obs = values[:, 0], values[:, 1], values[:, 2]
+            Ivalid = ~np.isnan(obs) & np.isfinite(curr_lats) & np.isfinite(curr_lons)
+            if Itime is None:
+                times = file_time * np.ones(len(obs), int)
+            else:
+                times = values[:, columns.index(Itime)]
+                Ivalid = Ivalid & np.isfinite(times) & (np.mod(np.nan_to_num(times), 1) == 0)
+            if Idqc is not None:
+                Ivalid = Ivalid & (values[:, columns.index(Idqc)] == 0)
+            Ivalid = np.where(Ivalid)[0]
+
+            dist, Inearest = tree.query(met2verif.util.lat_lon_to_xyz(curr_lats[Ivalid], curr_lons[Ivalid]),
+                                        distance_upper_bound=self.max_distance)
+            Imatched = np.where(np.isfinite(dist))[0]
+            I = Ivalid[Imatched]
+            curr = {"times": np.array(times[I], int), "ids": ids[Inearest[Imatched]], "obs": obs[I], "dist": dist[Imatched]}
+            matched = get_nearest(concatenate([matched, curr]))
+        ifile.close()
+        del matched["dist"]
+        yield matched
+
+    def parse_lines(self, lines, columns):
+        """ Parses lines one at a time, skipping lines that are not in the expected format
+
+        Returns:
+            np.array: 2D array (line, column)
+        """
+        rows = list()
+        for line in lines:
+            data = line.strip().split(';')
+            try:
+                rows += [[parse_value(data[I]) for I in columns]]
+            except Exception:
+                continue
+        return np.reshape(np.array(rows, float), [len(rows), len(columns)])
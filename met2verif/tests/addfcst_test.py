@@ -1,5 +1,7 @@
 import unittest
+import argparse
 import met2verif.addfcst
+import netCDF4
 import verif.input
 import os
 import numpy as np
@@ -19,7 +21,7 @@ class AddFcstTest(unittest.TestCase):
         command = "addfcst " + command + " -o %s" % file_temp
         argv = command.split()
         os.close(fd)
-        print command
+        print(command)
         met2verif.main(command.split())
         return file_temp
 
@@ -101,6 +103,60 @@ class AddFcstTest(unittest.TestCase):
         self.assertEqual(4, input.fcst[1, 0])
         self.assertEqual(8, input.fcst[1, 2])
 
+    def test_parallel(self):
+        """ Check that processing files in parallel gives the same result as in serial """
+        cmd = "met2verif/tests/files/f1.nc met2verif/tests/files/f6.nc -v air_temperature_2m -e 0"
+        file = self.run_addfcst(cmd)
+        file_parallel = self.run_addfcst(cmd + " -j 2")
+        expected = verif.input.get_input(file).fcst
+        np.testing.assert_array_equal(expected, verif.input.get_input(file_parallel).fcst)
+        self.remove(file)
+        self.remove(file_parallel)
+
+    def test_prefetch(self):
+        """ Check that reading files in a background thread gives the same result """
+        cmd = "met2verif/tests/files/f1.nc met2verif/tests/files/f6.nc -v air_temperature_2m -e 1"
+        file = self.run_addfcst(cmd)
+        file_prefetch = self.run_addfcst(cmd + " --prefetch 1")
+        expected = verif.input.get_input(file).fcst
+        np.testing.assert_array_equal(expected, verif.input.get_input(file_prefetch).fcst)
+        self.remove(file)
+        self.remove(file_prefetch)
+
+    def test_prefetch_error(self):
+        """ Check that an input that stops the run also stops it when prefetching """
+        fd, file_broken = tempfile.mkstemp(suffix=".nc")
+        os.close(fd)
+        file = netCDF4.Dataset(file_broken, 'w')
+        file.createDimension("time", 2)
+        file.createDimension("x", 2)
+        file.createDimension("y", 2)
+        file.createVariable("time", "i4", ("time",))
+        file.variables["time"][:] = [1514764800, 1514808000]
+        file.createVariable("air_temperature_2m", "f4", ("time", "x", "y"))
+        file.variables["air_temperature_2m"][:] = 1
+        file.close()
+        cmd = "%s met2verif/tests/files/f1.nc -v air_temperature_2m" % file_broken
+        for options in ["", " --prefetch 1"]:
+            with self.assertRaises(SystemExit):
+                self.run_addfcst(cmd + options)
+        os.remove(file_broken)
+
+    def test_wind_direction(self):
+        """ Check that directions are aggregated from the wind components """
+        # Members with directions 350 and 10, 90 and 270 (calm on average), and 180 and missing
+        direction = np.array([[350, 10], [90, 270], [180, np.nan]]) * np.pi / 180
+        x = np.round(-np.sin(direction), 10)[None, :, :]
+        y = np.round(-np.cos(direction), 10)[None, :, :]
+        args = argparse.Namespace(winddir=True, aggregator="mean", multiply=1, add=0)
+        results = met2verif.addfcst.aggregate_input((x, y), ([0], [[0]], [[0]]), args, [], [])
+        fcst, tfcst, qfcst, efcst = results[0]
+        self.assertAlmostEqual(0, np.sin(fcst[0, 0] * np.pi / 180))
+        self.assertAlmostEqual(1, np.cos(fcst[0, 0] * np.pi / 180))
+        self.assertTrue(np.isnan(fcst[0, 1]))
+        self.assertAlmostEqual(180, fcst[0, 2])
+        np.testing.assert_array_almost_equal([350, 10], efcst[0, 0])
+
     def test_get_time_indices(self):
         frt = met2verif.util.date_to_unixtime(20190101)
         output_times = list()
@@ -117,6 +173,52 @@ class AddFcstTest(unittest.TestCase):
         self.assertEqual(input, [[1, 1, 1, 2, 2, 2]])
         self.assertEqual(output, [[0, 1, 2, 3, 4, 5, 6]])
 
+    def test_time_window(self):
+        """ Check that time aggregation on a subset of times matches aggregation on all times """
+        np.random.seed(0)
+        values = np.random.rand(10, 3, 2)
+        Ilt = [2, 5, 9]
+        self.assertEqual([2, 5, 9], met2verif.addfcst.get_required_times(Ilt, 1, False))
+        self.assertEqual([2, 5, 6, 9], met2verif.addfcst.get_required_times(Ilt, 3, True))
+        self.assertEqual([3, 4, 5, 7, 8, 9], met2verif.addfcst.get_required_times(Ilt, 3, False))
+
+        for deacc in [False, True]:
+            expected = np.cumsum(values, axis=0) if not deacc else values.copy()
+            expected[3:, ...] = expected[3:, ...] - expected[0:-3, ...]
+            expected[0:3, ...] = np.nan
+
+            # Only provide the times that are needed
+            subset = np.nan * np.zeros(values.shape)
+            Ineeded = met2verif.addfcst.get_required_times(Ilt, 3, deacc)
+            subset[Ineeded, ...] = values[Ineeded, ...]
+            output = met2verif.addfcst.apply_time_window(subset, Ilt, 3, deacc)
+            np.testing.assert_array_almost_equal(expected[Ilt, ...], output[Ilt, ...])
+            self.assertTrue(np.isnan(output[[0, 1, 3, 4, 6, 7, 8], ...]).all())
+
+    def test_statistics(self):
+        """ Check that statistics from the sorted members match the numpy functions """
+        np.random.seed(0)
+        values = np.random.randn(4, 5, 11)
+        values[values > 1.2] = np.nan
+        values[0, 0, :] = np.nan
+        values[1, 1, :] = 1
+        thresholds = np.array([-1, 0, 1, 3])
+        quantiles = np.array([0, 0.1, 0.5, 0.9, 1])
+        Ivalid = np.isfinite(values).any(axis=2)
+        for aggregator in ["mean", "median", "min", "max"]:
+            fcst, tfcst, qfcst = met2verif.addfcst.compute_statistics(values, aggregator, thresholds, quantiles)
+            func = met2verif.addfcst.get_aggregator(aggregator)
+            np.testing.assert_array_almost_equal(func(values[Ivalid], axis=1), fcst[Ivalid])
+            self.assertTrue(np.isnan(fcst[0, 0]))
+
+        for t in range(len(thresholds)):
+            expected = np.sum(values[Ivalid] < thresholds[t], axis=1) / np.sum(np.isfinite(values[Ivalid]), axis=1)
+            np.testing.assert_array_almost_equal(expected, tfcst[Ivalid][:, t])
+        expected = np.nanpercentile(values[Ivalid], quantiles * 100, axis=1).T
+        np.testing.assert_array_almost_equal(expected, qfcst[Ivalid])
+        self.assertTrue(np.isnan(tfcst[0, 0, :]).all())
+        self.assertTrue(np.isnan(qfcst[0, 0, :]).all())
+
 
 if __name__ == '__main__':
     unittest.main()
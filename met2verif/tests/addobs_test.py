@@ -0,0 +1,65 @@
+import unittest
+import met2verif
+import met2verif.addobs
+import netCDF4
+import os
+import numpy as np
+import tempfile
+import shutil
+np.seterr('raise')
+
+
+class AddObsTest(unittest.TestCase):
+    def test_place(self):
+        """ Check that observations are placed in all matching slots, with the last duplicate used """
+        dir = tempfile.mkdtemp()
+        verif_file = os.path.join(dir, "verif.nc")
+        shutil.copy("met2verif/tests/files/obs.nc", verif_file)
+        obs_file = os.path.join(dir, "obs.txt")
+        with open(obs_file, "w") as file:
+            file.write("id;date;hour;TA\n")
+            file.write("1;20180101;6;1\n1;20180101;12;5\n2;20180101;12;7\n1;20180101;12;6\n1;20180102;0;-2\n1;20180103;0;3\n")
+        met2verif.main(("addobs %s -v TA -o %s -c --multiply 2 --add 1" % (obs_file, verif_file)).split())
+
+        file = netCDF4.Dataset(verif_file, 'r')
+        times = file.variables["time"][:]
+        values = np.ma.filled(file.variables["obs"][:, :, 0], np.nan)
+        file.close()
+        shutil.rmtree(dir)
+        np.testing.assert_array_equal([1514764800, 1514851200, 1514937600], times)
+        np.testing.assert_array_equal([[np.nan, 3, 13], [-3, np.nan, np.nan], [7, np.nan, np.nan]], values)
+
+    def test_num_processes(self):
+        """ Check that reading files in parallel gives the same result as reading them in order """
+        dir = tempfile.mkdtemp()
+        obs_files = list()
+        for i in range(3):
+            obs_files += [os.path.join(dir, "obs%d.txt" % i)]
+            with open(obs_files[-1], "w") as file:
+                file.write("id;date;hour;TA\n1;20180101;6;%d\n1;2018010%d;0;%d\n" % (i, i + 1, i + 10))
+        values = list()
+        for num_processes in [1, 2]:
+            verif_file = os.path.join(dir, "verif%d.nc" % num_processes)
+            shutil.copy("met2verif/tests/files/obs.nc", verif_file)
+            met2verif.main(("addobs %s -v TA -o %s -c -j %d" % (' '.join(obs_files), verif_file, num_processes)).split())
+            file = netCDF4.Dataset(verif_file, 'r')
+            values += [np.ma.filled(file.variables["obs"][:], np.nan)]
+            file.close()
+        shutil.rmtree(dir)
+        self.assertEqual(3, values[0].shape[0])
+        self.assertEqual(2, values[0][0, 1, 0])
+        np.testing.assert_array_equal(values[0], values[1])
+
+    def test_get_new_times(self):
+        """ Check that float32 leadtimes do not round the times """
+        leadtimes = np.array([0, 6, 12], np.float32)
+        times = met2verif.addobs.get_new_times(np.array([1514808000]), np.array([1514764800.]), leadtimes, [0, 12])
+        np.testing.assert_array_equal([1514808000], times)
+
+    def test_get_location_indices(self):
+        np.testing.assert_array_equal([1, -1, 0, 2], met2verif.addobs.get_location_indices(np.array([5, 1, 9, 1]), [1, 4, 5, 9]))
+        np.testing.assert_array_equal([-1], met2verif.addobs.get_location_indices(np.zeros(0, int), [1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
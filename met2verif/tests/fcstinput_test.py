@@ -0,0 +1,155 @@
+import unittest
+import met2verif.fcstinput
+import met2verif.util
+import netCDF4
+import os
+import numpy as np
+import tempfile
+from unittest import mock
+import shutil
+np.seterr('raise')
+
+
+class FcstInputTest(unittest.TestCase):
+
+    def test_index_cache(self):
+        """ Check that nearest neighbour lookups are reused from memory and from disk """
+        cache_dir = tempfile.mkdtemp()
+        lats = np.array([61, 58.2])
+        lons = np.array([11, 8.1])
+        input = met2verif.fcstinput.get('met2verif/tests/files/f11.nc', cache_dir)
+        I, J = input.get_i_j(lats, lons)
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+        # Coordinates are not kept on the object after the lookup
+        self.assertFalse(hasattr(input, "grid"))
+
+        met2verif.fcstinput._index_cache.clear()
+        input = met2verif.fcstinput.get('met2verif/tests/files/f11.nc', cache_dir)
+        I2, J2 = input.get_i_j(lats, lons)
+        np.testing.assert_array_equal(I, I2)
+        np.testing.assert_array_equal(J, J2)
+
+        # Different points must not reuse the lookup
+        input.get_i_j(lats[0:1], lons[0:1])
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+        shutil.rmtree(cache_dir)
+
+    def test_latlon_lookup(self):
+        """ Check that the tree search gives the same neighbours as a brute-force search """
+        np.random.seed(0)
+        ilons, ilats = np.meshgrid(np.linspace(5, 15, 30), np.linspace(55, 65, 20))
+        ilats = ilats + np.random.uniform(-0.1, 0.1, ilats.shape)
+        ilons = ilons + np.random.uniform(-0.1, 0.1, ilons.shape)
+        grid = {"type": "latlon", "projection": None, "x": None, "y": None, "lats": ilats, "lons": ilons}
+        lats = np.append(np.random.uniform(54, 66, 50), np.nan)
+        lons = np.append(np.random.uniform(4, 16, 50), 10)
+        I, J = met2verif.fcstinput.compute_i_j(grid, lats, lons)
+        for i in range(50):
+            dist = met2verif.util.distance(lats[i], lons[i], ilats, ilons)
+            self.assertEqual(np.unravel_index(dist.argmin(), dist.shape), (I[i], J[i]))
+        self.assertEqual(-1, I[-1])
+        self.assertEqual(-1, J[-1])
+
+    def test_nearest_index(self):
+        """ Check binary search on descending axes and across the longitude wrap-around """
+        lats = np.arange(90, -90.1, -0.25)
+        values = np.array([59.9, 60.1, -89.99, 90, 10.125])
+        I = met2verif.fcstinput.get_nearest_index(lats, values)
+        for i in range(len(values)):
+            self.assertEqual(np.argmin(np.abs(values[i] - lats)), I[i])
+
+        lons = np.arange(0, 360, 0.5)
+        I = met2verif.fcstinput.get_nearest_index(lons, np.array([10.2, -10.2, 359.9, -0.1, 180]), 360)
+        np.testing.assert_array_equal([20, 700, 0, 0, 360], I)
+
+        lons = np.arange(-180, 180, 1.0)
+        I = met2verif.fcstinput.get_nearest_index(lons, np.array([350, 179.8, 10]), 360)
+        np.testing.assert_array_equal([170, 0, 190], I)
+
+    def test_read_blocks(self):
+        """ Check that all points are covered by blocks that respect the size limit """
+        np.random.seed(0)
+        I = np.random.randint(0, 500, 300)
+        J = np.random.randint(0, 400, 300)
+        blocks = met2verif.fcstinput.get_read_blocks(I, J, 10, max_gap=4, max_size=20000)
+        Ipoints = np.sort(np.concatenate([block[4] for block in blocks]))
+        np.testing.assert_array_equal(np.arange(300), Ipoints)
+        for r0, r1, c0, c1, Ipoints in blocks:
+            self.assertTrue(len(Ipoints) == 1 or (r1 - r0 + 1) * (c1 - c0 + 1) * 10 <= 20000)
+            self.assertTrue((I[Ipoints] >= r0).all() and (I[Ipoints] <= r1).all())
+            self.assertTrue((J[Ipoints] >= c0).all() and (J[Ipoints] <= c1).all())
+
+    def test_read_points(self):
+        """ Check that reading points gives the same as reading the full field """
+        file = netCDF4.Dataset('met2verif/tests/files/f6.nc', 'r')
+        var = file.variables['air_temperature_2m']
+        full = np.moveaxis(var[:], [0, 3, 1, 2], [0, 1, 2, 3])
+        I = np.array([0, 1, 1, 0, 2])
+        J = np.array([0, 1, 0, 0, 0])
+        values = met2verif.fcstinput.read_points(var, 0, 3, 1, 2, I, J, [1, 0])
+        self.assertEqual((2, 5, 2), values.shape)
+        np.testing.assert_array_equal(full[:, I[0:4], J[0:4], :][:, :, [1, 0]], values[:, 0:4, :])
+        self.assertTrue(np.isnan(values[:, 4, :]).all())
+        file.close()
+
+    def test_session(self):
+        """ Check that the file is only opened once in a session """
+        input = met2verif.fcstinput.get('met2verif/tests/files/f6.nc')
+        lats = np.array([61, 58.2])
+        lons = np.array([11, 8.1])
+        expected = input.extract(lats, lons, 'air_temperature_2m', [0, 1])
+        with mock.patch('netCDF4.Dataset', wraps=netCDF4.Dataset) as dataset:
+            with input:
+                values = input.extract(lats, lons, 'air_temperature_2m', [0, 1])
+                values2 = input.extract(lats, lons, 'air_temperature_2m', [1])
+            self.assertEqual(1, dataset.call_count)
+        self.assertTrue(input.session is None)
+        np.testing.assert_array_equal(expected, values)
+        np.testing.assert_array_equal(expected[:, :, 1:2], values2)
+
+    def test_neighbourhood(self):
+        """ Check that neighbourhoods are read as one array and are missing outside the domain """
+        input = met2verif.fcstinput.get('met2verif/tests/files/f11.nc')
+        values = input.extract(np.array([60.5, 58]), np.array([10, 8]), 'air_temperature_2m', [0], hood=1)
+        self.assertEqual((1, 2, 9), values.shape)
+        np.testing.assert_array_almost_equal([1, 2, 3, 4, 5, 6, 7, 8.415, 9], np.sort(values[0, 0, :]))
+        self.assertEqual(5, np.sum(np.isnan(values[0, 1, :])))
+        np.testing.assert_array_almost_equal([1, 2, 4, 5], np.sort(values[0, 1, :])[0:4])
+
+    def test_interpolation(self):
+        """ Check that bilinear interpolation reproduces a linear field, also across the date line """
+        lats = np.arange(70, 50, -0.5)
+        lons = np.arange(0, 360, 1.0)
+        grid = {"type": "regular", "projection": None, "x": None, "y": None, "lats": lats, "lons": lons}
+        field = 2 * lats[:, None] + np.cos(lons[None, :] * np.pi / 180)
+        slats = np.array([60.2, 55.1, np.nan, 80])
+        slons = np.array([10, 359.5, 3, 3])
+        I, J, W = met2verif.fcstinput.compute_weights(grid, slats, slons, "bilinear")
+        self.assertEqual((4, len(I)), W.shape)
+        values = met2verif.fcstinput.apply_weights(W, field[I, J][None, :, None])
+        self.assertEqual((1, 4, 1), values.shape)
+        expected = [120.4 + np.cos(10 * np.pi / 180), 110.2 + (np.cos(359 * np.pi / 180) + 1) / 2]
+        np.testing.assert_array_almost_equal(expected, values[0, 0:2, 0])
+        self.assertTrue(np.isnan(values[0, 2:4, 0]).all())
+
+        # Missing gridpoints are left out
+        field[I[0], J[0]] = np.nan
+        values = met2verif.fcstinput.apply_weights(W, field[I, J][None, :, None])
+        self.assertTrue(np.isfinite(values[0, 0:2, 0]).all())
+
+    def test_extract_interpolation(self):
+        """ Check that interpolated values match the gridpoint values at gridpoints """
+        input = met2verif.fcstinput.get('met2verif/tests/files/f11.nc')
+        lats = np.array([60.5, 58, 61])
+        lons = np.array([10, 8, 11])
+        nearest = input.extract(lats, lons, 'air_temperature_2m', [0])
+        values = input.extract(lats, lons, 'air_temperature_2m', [0], interpolation="idw")
+        self.assertEqual((1, 3, 1), values.shape)
+        np.testing.assert_array_almost_equal(nearest[0, 0:2, 0], values[0, 0:2, 0])
+        self.assertTrue(5 < values[0, 2, 0] < 9)
+        with self.assertRaises(Exception):
+            input.extract(lats, lons, 'air_temperature_2m', [0], hood=1, interpolation="idw")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import met2verif
+import met2verif.ledger
+import met2verif.fcstinput
+import argparse
+import os
+import numpy as np
+import tempfile
+import shutil
+from unittest import mock
+np.seterr('raise')
+
+
+class LedgerTest(unittest.TestCase):
+    def test_has(self):
+        """ Check that files are only skipped when they and the options are unchanged """
+        dir = tempfile.mkdtemp()
+        input = os.path.join(dir, "input.txt")
+        with open(input, "w") as file:
+            file.write("1")
+        filename = os.path.join(dir, "ledger.db")
+        ledger = met2verif.ledger.Ledger(filename, "verif.nc", "fcst", "options")
+        self.assertFalse(ledger.has(input))
+        ledger.add([input, os.path.join(dir, "missing.txt")])
+        self.assertTrue(ledger.has(input))
+        self.assertFalse(ledger.has(os.path.join(dir, "missing.txt")))
+        ledger.close()
+
+        # Other variables, verif files, and options are recorded separately
+        self.assertTrue(met2verif.ledger.Ledger(filename, "verif.nc", "fcst", "options").has(input))
+        self.assertFalse(met2verif.ledger.Ledger(filename, "verif.nc", "obs", "options").has(input))
+        self.assertFalse(met2verif.ledger.Ledger(filename, "verif2.nc", "fcst", "options").has(input))
+        self.assertFalse(met2verif.ledger.Ledger(filename, "verif.nc", "fcst", "options2").has(input))
+
+        ledger = met2verif.ledger.Ledger(filename, "verif.nc", "fcst", "options")
+        stat = os.stat(input)
+        os.utime(input, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertFalse(ledger.has(input))
+        ledger.add([input])
+        self.assertTrue(ledger.has(input))
+        ledger.clear()
+        self.assertFalse(ledger.has(input))
+        ledger.close()
+        shutil.rmtree(dir)
+
+    def test_options_hash(self):
+        """ Check that only options that affect the values change the fingerprint """
+        args = argparse.Namespace(files=["a.nc"], variable="air_temperature_2m", debug=False, members=[0])
+        hash = met2verif.ledger.get_options_hash(args)
+        self.assertEqual(hash, met2verif.ledger.get_options_hash(argparse.Namespace(files=["b.nc"], variable="air_temperature_2m", debug=True, members=[0])))
+        self.assertNotEqual(hash, met2verif.ledger.get_options_hash(argparse.Namespace(files=["a.nc"], variable="air_temperature_2m", debug=False, members=[1])))
+
+    def test_addfcst(self):
+        """ Check that addfcst does not open files it has added before, unless clearing """
+        dir = tempfile.mkdtemp()
+        verif_file = os.path.join(dir, "verif.nc")
+        shutil.copy("met2verif/tests/files/obs.nc", verif_file)
+        command = "addfcst met2verif/tests/files/f1.nc -v air_temperature_2m -e 0 -o %s --ledger %s" % (verif_file, os.path.join(dir, "ledger.db"))
+        met2verif.main(command.split())
+        with mock.patch('met2verif.fcstinput.get', wraps=met2verif.fcstinput.get) as get:
+            met2verif.main(command.split())
+            self.assertEqual(0, get.call_count)
+            met2verif.main((command + " -c").split())
+            self.assertEqual(1, get.call_count)
+            met2verif.main(command.split())
+            self.assertEqual(1, get.call_count)
+        shutil.rmtree(dir)
+
+    def test_recreate(self):
+        """ Check that files are added again when the verif file is re-created at the same path """
+        dir = tempfile.mkdtemp()
+        verif_file = os.path.join(dir, "verif.nc")
+        init = "init -l met2verif/tests/files/obs.nc -lt 0,6,12 -o %s" % verif_file
+        met2verif.main(init.split())
+        identity = met2verif.ledger.get_verif_identity(verif_file)
+        self.assertNotEqual("", identity)
+        command = "addfcst met2verif/tests/files/f1.nc -v air_temperature_2m -e 0 -o %s --ledger %s" % (verif_file, os.path.join(dir, "ledger.db"))
+        met2verif.main(command.split())
+        self.assertEqual(identity, met2verif.ledger.get_verif_identity(verif_file))
+        with mock.patch('met2verif.fcstinput.get', wraps=met2verif.fcstinput.get) as get:
+            met2verif.main(command.split())
+            self.assertEqual(0, get.call_count)
+            # Same locations and leadtimes, but a new file
+            met2verif.main(init.split())
+            self.assertNotEqual(identity, met2verif.ledger.get_verif_identity(verif_file))
+            met2verif.main(command.split())
+            self.assertEqual(1, get.call_count)
+            met2verif.main(command.split())
+            self.assertEqual(1, get.call_count)
+        shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
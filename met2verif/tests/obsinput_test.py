@@ -0,0 +1,164 @@
+import unittest
+import met2verif.obsinput
+import netCDF4
+import os
+import numpy as np
+import tempfile
+np.seterr('raise')
+
+
+class ObsInputTest(unittest.TestCase):
+    @staticmethod
+    def write(text):
+        """ Writes text to a temporary file and returns its name """
+        fd, filename = tempfile.mkstemp(suffix=".txt")
+        os.close(fd)
+        with open(filename, 'w') as file:
+            file.write(text)
+        return filename
+
+    def check_read(self, filename, variable, expected):
+        input = met2verif.obsinput.get(filename)
+        data = input.read(variable)
+        os.remove(filename)
+        np.testing.assert_array_equal(expected["times"], data["times"])
+        np.testing.assert_array_equal(expected["ids"], data["ids"])
+        np.testing.assert_array_almost_equal(expected["obs"], data["obs"])
+        self.assertEqual(int, data["times"].dtype)
+        self.assertEqual(int, data["ids"].dtype)
+
+    def test_text(self):
+        """ Check that missing values are skipped, both with and without invalid lines """
+        header = "id;date;hour;TA;RR\n"
+        lines = "18700;20180101;6;1.5;.\n18700;20180102;0;x;1\n1;20180102;23;-2;0\n"
+        expected = {"times": [1514786400, 1514934000], "ids": [18700, 1], "obs": [1.5, -2]}
+        self.check_read(self.write(header + lines), "TA", expected)
+        self.check_read(self.write(header + lines + "\nsome text\n1;20180101;1.5;3;4"), "TA", expected)
+        expected = {"times": [1514851200, 1514934000], "ids": [18700, 1], "obs": [1, 0]}
+        self.check_read(self.write(header + lines), "RR", expected)
+
+    def test_kdvh(self):
+        """ Check that minutes are added to the time """
+        header = " Stnr Year Month Day Time(UTC) MIN TA\n"
+        lines = "  18700 2018  1  1  6  0 1.5\n  18700 2018  1  2  0 30 x\n  1 2018 1 2 23 7 -2\n"
+        expected = {"times": [1514786400, 1514934420], "ids": [18700, 1], "obs": [1.5, -2]}
+        self.check_read(self.write(header + lines), "TA", expected)
+        self.check_read(self.write(header + lines + " Sum 2018 1 1 1 1 1\n"), "TA", expected)
+
+    def test_read_chunks(self):
+        """ Check that reading in chunks gives the same observations as reading all at once """
+        header = "id;date;hour;TA\n"
+        lines = "18700;20180101;6;1.5\n18700;20180102;0;x\nsome text\n1;20180102;23;-2\n2;20180103;0;4\n"
+        filename = self.write(header + lines)
+        input = met2verif.obsinput.get(filename)
+        chunks = list(input.read_chunks("TA", chunk_size=2))
+        self.assertEqual(3, len(chunks))
+        expected = input.read("TA")
+        os.remove(filename)
+        np.testing.assert_array_equal([1514786400], chunks[0]["times"])
+        for key in ["times", "ids", "obs"]:
+            np.testing.assert_array_equal(expected[key], np.concatenate([chunk[key] for chunk in chunks]))
+
+    def test_netcdf(self):
+        """ Check reading (location, time) arrays and lists of points, with times in other units """
+        fd, filename = tempfile.mkstemp(suffix=".nc")
+        os.close(fd)
+        file = netCDF4.Dataset(filename, 'w')
+        file.createDimension("time", 3)
+        file.createDimension("station", 2)
+        file.createDimension("obs", 3)
+        file.createVariable("time", "f8", ("time",))
+        file.variables["time"].units = "hours since 2018-01-01 00:00:00"
+        file.variables["time"][:] = [6, 24, 47]
+        file.createVariable("station_id", "i4", ("station",))
+        file.variables["station_id"][:] = [18700, 1]
+        file.createVariable("TA", "f4", ("station", "time"))
+        file.variables["TA"][:] = [[1.5, np.nan, 3], [-2, 4, 5]]
+        file.variables["TA"][0, 2] = np.ma.masked
+        file.close()
+        expected = {"times": [1514786400, 1514786400, 1514851200, 1514934000], "ids": [18700, 1, 1, 1], "obs": [1.5, -2, 4, 5]}
+        self.assertTrue(isinstance(met2verif.obsinput.get(filename), met2verif.obsinput.Netcdf))
+        input = met2verif.obsinput.get(filename)
+        self.assertEqual(2, len(list(input.read_chunks("TA", chunk_size=4))))
+        self.check_read(filename, "TA", expected)
+
+        fd, filename = tempfile.mkstemp(suffix=".nc")
+        os.close(fd)
+        file = netCDF4.Dataset(filename, 'w', format="NETCDF3_CLASSIC")
+        file.createDimension("obs", 3)
+        file.createVariable("time", "i4", ("obs",))
+        file.variables["time"][:] = [1514786400, 1514934000, 1514934000]
+        file.createVariable("location", "i4", ("obs",))
+        file.variables["location"][:] = [18700, 1, 18700]
+        file.createVariable("TA", "f4", ("obs",))
+        file.variables["TA"][:] = [1.5, -2, np.nan]
+        file.close()
+        expected = {"times": [1514786400, 1514934000], "ids": [18700, 1], "obs": [1.5, -2]}
+        self.check_read(filename, "TA", expected)
+
+    def test_titan(self):
+        """ Check that observations are matched to the nearest location within the distance """
+        locations = {18700: {"lat": 60, "lon": 10}, 1: {"lat": 61, "lon": 10}}
+        dir = tempfile.mkdtemp()
+        filename = os.path.join(dir, "obs_2018010106.txt")
+        with open(filename, 'w') as file:
+            file.write("lat;lon;elev;value;prid;dqc\n")
+            # Observations that are too far away, missing, or flagged are removed
+            file.write("60.001;10;100;1.5;1;0\n60.5;10;100;2;1;0\n61;10.001;100;.;1;0\n61;10;100;3;1;1\n")
+            file.write("60.002;10;100;5;1;0\n60;10.0001;100;4;1;0\n")
+        input = met2verif.obsinput.get(filename, locations=locations, max_distance=1000)
+        self.assertTrue(isinstance(input, met2verif.obsinput.Titan))
+        data = input.read("TA")
+        np.testing.assert_array_equal([1514786400], data["times"])
+        np.testing.assert_array_equal([18700], data["ids"])
+        # The nearest observation is used
+        np.testing.assert_array_equal([4], data["obs"])
+
+        # The nearest observation is used when duplicates are in different chunks
+        for rows in [("60.005;10;100;7;1;0\n", "60;10;100;8;1;0\n"), ("60;10;100;8;1;0\n", "60.005;10;100;7;1;0\n")]:
+            with open(filename, 'w') as file:
+                file.write("lat;lon;elev;value;prid;dqc\n" + rows[0] + rows[1])
+            input = met2verif.obsinput.get(filename, locations=locations)
+            chunks = list(input.read_chunks("TA", chunk_size=1))
+            self.assertEqual(1, len(chunks))
+            np.testing.assert_array_equal([18700], chunks[0]["ids"])
+            np.testing.assert_array_equal([8], chunks[0]["obs"])
+
+        with open(filename, 'w') as file:
+            file.write("lat;lon;time;TA\n61;10;1514764800;1\nsome text\n60;10;1514768400;2\n")
+        data = met2verif.obsinput.get(filename, locations=locations).read("TA")
+        np.testing.assert_array_equal([1514764800, 1514768400], data["times"])
+        np.testing.assert_array_equal([1, 18700], data["ids"])
+        np.testing.assert_array_equal([1, 2], data["obs"])
+        os.remove(filename)
+        os.rmdir(dir)
+
+    def test_cache(self):
+        """ Check that all variables are read from the cache, and that changed files are parsed again """
+        cache_dir = tempfile.mkdtemp()
+        header = " Stnr Year Month Day Time(UTC) TA RR\n"
+        lines = "  18700 2018  1  1  6 1.5 .\n  18700 2018  1  2  0 x 2\n  1 2018 1 2 23 -2 0\n"
+        filename = self.write(header + lines)
+        for variable in ["TA", "RR", "TA"]:
+            expected = met2verif.obsinput.get(filename).read(variable)
+            data = met2verif.obsinput.get(filename, cache_dir).read(variable)
+            for key in ["times", "ids", "obs"]:
+                np.testing.assert_array_equal(expected[key], data[key])
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+        # Only the requested variable is loaded
+        cache = met2verif.obsinput.get(filename, cache_dir).load_cache("RR")
+        self.assertEqual(["ids", "times", "values_1", "variables"], sorted(cache.keys()))
+
+        with open(filename, 'a') as file:
+            file.write("  1 2018 1 3 0 4 5\n")
+        data = met2verif.obsinput.get(filename, cache_dir).read("RR")
+        np.testing.assert_array_equal([2, 0, 5], data["obs"])
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+        os.remove(filename)
+        for name in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+        os.rmdir(cache_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
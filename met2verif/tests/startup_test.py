@@ -0,0 +1,16 @@
+import unittest
+import subprocess
+import sys
+
+
+class StartupTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        """ Check that setting up the command-line parser does not import slow modules """
+        code = "import sys, met2verif; met2verif.main(['--version']); " \
+               "print(' '.join(m for m in ['matplotlib', 'scipy', 'pyproj', 'verif', 'requests'] if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, "-c", code]).decode().split('\n')
+        self.assertEqual("", output[1].strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import unittest
+import met2verif.timerows
+import netCDF4
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+np.seterr('raise')
+
+
+class TimeRowsTest(unittest.TestCase):
+    def create_file(self, filename):
+        file = netCDF4.Dataset(filename, 'w')
+        file.createDimension("time", None)
+        file.createDimension("leadtime", 2)
+        file.createDimension("location", 3)
+        file.createDimension("threshold", 2)
+        file.createVariable("time", "i4", ("time",))
+        file.createVariable("fcst", "f4", ("time", "leadtime", "location"))
+        file.createVariable("cdf", "f4", ("time", "leadtime", "location", "threshold"))
+        file.variables["time"][:] = [0, 1, 2]
+        file.variables["fcst"][:] = np.arange(18).reshape([3, 2, 3])
+        return file
+
+    def test_read_write(self):
+        """ Check that only changed rows are written, and that new times are not read """
+        fd, filename = tempfile.mkstemp(suffix=".nc")
+        os.close(fd)
+        file = self.create_file(filename)
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], num_existing=3)
+        np.testing.assert_array_equal([[6, 7, 8], [9, 10, 11]], rows.get(1))
+        rows.set(1, (0, 1), np.nan)
+        file.variables["time"][3:] = [3, 4]
+        file.variables["fcst"][3, ...] = 100
+        self.assertTrue(np.isnan(rows.get(3)).all())
+        self.assertTrue(np.isnan(rows.get(4)).all())
+        rows.set(4, 1, [1, 2, 3])
+        rows.set(2, [0, 1], -1)
+        self.assertEqual(set([1, 2, 4]), rows.changed)
+        rows.write()
+        self.assertEqual(0, len(rows.changed))
+
+        # New times that have been written are read back after flushing
+        rows.flush()
+        self.assertEqual(0, len(rows.rows))
+        np.testing.assert_array_equal([1, 2, 3], rows.get(4)[1])
+        file.close()
+
+        file = netCDF4.Dataset(filename, 'r')
+        values = file.variables["fcst"][:]
+        file.close()
+        os.remove(filename)
+        np.testing.assert_array_equal(np.arange(6).reshape([2, 3]), values[0])
+        self.assertTrue(values.mask[1, 0, 1])
+        self.assertEqual(6, values[1, 0, 0])
+        np.testing.assert_array_equal(-1, values[2])
+        np.testing.assert_array_equal(100, values[3])
+        np.testing.assert_array_equal([1, 2, 3], values[4, 1])
+
+    def test_max_rows(self):
+        """ Check that rows are written and freed when there would be too many in memory """
+        fd, filename = tempfile.mkstemp(suffix=".nc")
+        os.close(fd)
+        file = self.create_file(filename)
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], max_rows=2)
+        rows.set(0, 0, 1)
+        rows.set(1, 0, 2)
+        rows.set(0, 1, 3)
+        self.assertEqual(set([0, 1]), set(rows.rows.keys()))
+        rows.set(2, 0, 4)
+        self.assertEqual([2], list(rows.rows.keys()))
+        np.testing.assert_array_equal([[1, 1, 1], [3, 3, 3]], file.variables["fcst"][0])
+        np.testing.assert_array_equal([[2, 2, 2], [9, 10, 11]], file.variables["fcst"][1])
+        rows.write()
+        np.testing.assert_array_equal(4, file.variables["fcst"][2, 0])
+        file.close()
+        os.remove(filename)
+
+    def test_clear(self):
+        """ Check clearing the file and using one index of the last dimension """
+        fd, filename = tempfile.mkstemp(suffix=".nc")
+        os.close(fd)
+        file = self.create_file(filename)
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], clear=True)
+        self.assertTrue(np.isnan(rows.get(0)).all())
+        rows.clear(3, chunk_size=2)
+        rows.set(0, 0, 1)
+        rows.write()
+
+        cdf = met2verif.timerows.TimeRows(file.variables["cdf"], 1)
+        self.assertEqual([2, 3], list(cdf.get(0).shape))
+        cdf.set(2, 0, 0.5)
+        cdf.write()
+        values = file.variables["fcst"][:]
+        cdf_values = file.variables["cdf"][:]
+        file.close()
+        os.remove(filename)
+        np.testing.assert_array_equal(1, values[0, 0])
+        self.assertTrue(values.mask[0, 1].all())
+        self.assertTrue(values.mask[1:].all())
+        np.testing.assert_array_equal(0.5, cdf_values[2, 0, :, 1])
+        self.assertTrue(cdf_values.mask[2, 0, :, 0].all())
+
+    def test_coverage(self):
+        """ Check that the coverage is found from the rows that are checked, and kept up to date """
+        dir = tempfile.mkdtemp()
+        filename = os.path.join(dir, "verif.nc")
+        file = self.create_file(filename)
+        file.variables["fcst"][1, 0, :] = np.ma.masked
+        file.variables["fcst"][2, 1, 0:2] = np.ma.masked
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], coverage=True)
+        # verif shows all variables in the file as fields
+        self.assertFalse("fcst_coverage" in file.variables)
+        # Nothing is read until a time is checked, and checked rows are not kept
+        np.testing.assert_array_equal(-1, rows.coverage)
+        np.testing.assert_array_equal([False, True], rows.is_filled(1, [0, 1]))
+        np.testing.assert_array_equal([[-1, -1], [0, 1], [-1, -1]], rows.coverage)
+        self.assertEqual(0, len(rows.rows))
+
+        # Unwritten changes are also seen
+        rows.set(1, 0, np.nan)
+        rows.set(1, (0, 2), 3)
+        rows.set(2, 0, np.nan)
+        np.testing.assert_array_equal([True, True], rows.is_filled(1, [0, 1]))
+        np.testing.assert_array_equal([False], rows.is_filled(2, [0]))
+        file.variables["time"][3] = 3
+        rows.set(3, 1, 1)
+        rows.write()
+        np.testing.assert_array_equal([[-1, -1], [1, 1], [0, 1], [0, 1]], rows.coverage)
+
+        cdf = met2verif.timerows.TimeRows(file.variables["cdf"], 1, coverage=True)
+        cdf.set(0, 1, 0.5)
+        cdf.write()
+        np.testing.assert_array_equal([[0, 1], [-1, -1], [-1, -1], [-1, -1]], cdf.coverage)
+        file.close()
+        rows.close()
+        cdf.close()
+        self.assertEqual(["verif.nc", "verif.nc.cdf_1_coverage.npz", "verif.nc.fcst_coverage.npz"], sorted(os.listdir(dir)))
+
+        # The coverage file is used when the verif file has not changed since. Opening a
+        # NETCDF4 file for writing changes it, so the stamp is taken before.
+        stamp = met2verif.timerows.get_stamp(filename)
+        file = netCDF4.Dataset(filename, 'a')
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], coverage=True, stamp=stamp)
+        np.testing.assert_array_equal([[-1, -1], [1, 1], [0, 1], [0, 1]], rows.coverage)
+        rows.coverage[3, 1] = 0
+        file.close()
+        rows.close()
+        stamp = met2verif.timerows.get_stamp(filename)
+        file = netCDF4.Dataset(filename, 'a')
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], coverage=True, stamp=stamp)
+        np.testing.assert_array_equal([False, False], rows.is_filled(3, [0, 1]))
+
+        # Other tools that write to the verif file make the coverage file out of date. Wait
+        # such that the modification time changes on file systems with coarse timestamps.
+        time.sleep(0.05)
+        file.variables["fcst"][2, 0, 0] = 1
+        file.close()
+        stamp = met2verif.timerows.get_stamp(filename)
+        file = netCDF4.Dataset(filename, 'a')
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], coverage=True, stamp=stamp)
+        np.testing.assert_array_equal(-1, rows.coverage)
+        np.testing.assert_array_equal([True, True], rows.is_filled(2, [0, 1]))
+        np.testing.assert_array_equal([True], rows.is_filled(0, [0]))
+        file.close()
+        rows.close()
+
+        # Coverage files from other versions are not used
+        rows.coverage[0, 0] = 0
+        np.savez(rows.coverage_filename, version=0, stamp=met2verif.timerows.get_stamp(filename), coverage=rows.coverage)
+        file = netCDF4.Dataset(filename, 'r')
+        rows = met2verif.timerows.TimeRows(file.variables["fcst"], coverage=True)
+        np.testing.assert_array_equal(-1, rows.coverage)
+        file.close()
+        shutil.rmtree(dir)
+
+if __name__ == '__main__':
+    unittest.main()
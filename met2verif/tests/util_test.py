@@ -13,6 +13,35 @@ class UtilTest(unittest.TestCase):
     def convert_times_test(self):
         self.assertEqual(1571835600, met2verif.util.convert_time(1571835600, "seconds since 1970-01-01 00:00:00 +00:00"))
 
+    def test_convert_time(self):
+        """ Check scalars, arrays, time zones, rounding, and calendars that need num2date """
+        units = "hours since 2018-01-01 00:00:00"
+        self.assertEqual(1514764800 + 3600, met2verif.util.convert_time(1, units))
+        self.assertTrue(isinstance(met2verif.util.convert_time(np.float32(1), units), int))
+        np.testing.assert_array_equal([1514764800 - 5400, 1514764800, 1514764800 + 360],
+                                      met2verif.util.convert_time(np.array([-1.5, 0, 0.1]), units))
+        self.assertEqual(82800, met2verif.util.convert_time(1.0, "days since 1970-01-01 00:00:00 +01:00"))
+        # Within a microsecond of a whole second
+        self.assertEqual(7570253952, met2verif.util.convert_time(87618.68, "days since 1970-1-1"))
+        self.assertEqual(0, len(met2verif.util.convert_time(np.zeros(0), units)))
+        # There is no 29 February in the noleap calendar
+        np.testing.assert_array_equal([946684800, 978307200],
+                                      met2verif.util.convert_time([0, 365], "days since 2000-01-01", "noleap"))
+        self.assertEqual(-14831769600, met2verif.util.convert_time(0, "days since 1500-01-01"))
+
+    def test_wind(self):
+        x = np.array([0, -1, 3, 0])
+        y = np.array([-1, 0, 4, 0])
+        np.testing.assert_array_almost_equal([1, 1, 5, 0], met2verif.util.compute_wind_speed(x, y))
+        np.testing.assert_array_almost_equal([0, 90], met2verif.util.compute_wind_direction(x[0:2], y[0:2]))
+        self.assertTrue(np.isnan(met2verif.util.compute_wind_direction(x, y)[3]))
+
+    def test_dewpoint(self):
+        temperature = np.array([273.15, 293.15, 293.15])
+        dewpoint = met2verif.util.compute_dewpoint(temperature, np.array([1, 1, 0.5]))
+        np.testing.assert_array_almost_equal(temperature[0:2], dewpoint[0:2])
+        self.assertAlmostEqual(282.4, dewpoint[2], 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,227 @@
+import netCDF4
+import numpy as np
+import os
+import tempfile
+
+import met2verif.util
+
+
+# Increase when the coverage files change, such that older files are recomputed
+COVERAGE_VERSION = 2
+
+
+def get_stamp(filename):
+    """ Returns the size and modification time of a file, to check if it has changed.
+    Take it before opening a verif file for writing, since opening NETCDF4 files for
+    writing changes the modification time. """
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TimeRows(object):
+    """
+    Reads and writes a variable in a verif file one time at a time
+
+    A row holds all values (leadtime, location, ...) for one index of the time dimension.
+    Rows are read from the file when first used, and only rows that have been changed are
+    written back, such that memory usage and I/O scale with the times touched by a run and
+    not with the length of the file. Missing values are nan in the rows and fill values in
+    the file.
+
+    Optionally, a coverage array (dimensions as a row, except location) records which slots
+    have data at any location (1), no data (0), or are not known yet (-1), such that
+    is_filled can check if a slot has data without reading the values. Times that are not
+    known are found from the row the first time they are checked. The coverage is kept in
+    <verif file>.<name>[_<index>]_coverage.npz next to the verif file, and not in the verif
+    file itself, where verif would show it as a field. The coverage file is only used if the
+    verif file has not changed since close() wrote it, otherwise all times start as not
+    known. The file is never scanned, so a run only reads the rows it checks.
+    """
+    def __init__(self, var, index=None, clear=False, num_existing=None, coverage=False, stamp=None, max_rows=None):
+        """
+        Arguments:
+            var (netCDF4.Variable): Variable with time as the first dimension
+            index (int): If not None, only use this index of the last dimension (e.g. one
+                threshold of a threshold field)
+            clear (bool): Ignore the values already in the file. Rows that are never changed
+                are left as they are in the file, use clear() to remove them.
+            num_existing (int): Number of times that existed in the file before the run.
+                Rows for later times are new and are not read from the file. If None, read
+                all rows from the file.
+            coverage (bool): Keep track of which slots have data, starting from the coverage
+                file if it is up to date. Call close() after closing the verif file to save
+                it.
+            stamp (list): get_stamp of the verif file from before it was opened. If None,
+                the stamp is taken now.
+            max_rows (int): If not None, all rows are written and freed (flush) before more
+                than this many rows would be held in memory. Rows returned by get() earlier
+                can then be freed, so change rows with set().
+        """
+        self.var = var
+        self.index = index
+        self.ignore_file = clear
+        self.num_existing = num_existing
+        self.max_rows = max_rows
+        self.rows = dict()
+        self.changed = set()
+        self.written = set()
+        self.row_shape = list(var.shape[1:])
+        if index is not None:
+            self.row_shape = self.row_shape[0:-1]
+        # Axis of the location dimension in a row
+        self.location_axis = var.dimensions.index("location") - 1
+        self.coverage_shape = [n for i, n in enumerate(self.row_shape) if i != self.location_axis]
+
+        self.coverage = None
+        self.coverage_filename = None
+        if coverage:
+            self.verif_filename = var.group().filepath()
+            name = var.name if index is None else "%s_%d" % (var.name, index)
+            self.coverage_filename = "%s.%s_coverage.npz" % (self.verif_filename, name)
+            if stamp is None:
+                stamp = get_stamp(self.verif_filename)
+            self.coverage = self.load_coverage(stamp)
+            if self.coverage is None:
+                self.coverage = -np.ones([var.shape[0]] + self.coverage_shape, 'i1')
+
+    def get(self, Itime):
+        """ Returns the row for a time index. Changes to the row must be registered with set() """
+        if Itime not in self.rows:
+            if self.max_rows is not None and len(self.rows) >= self.max_rows:
+                self.flush()
+            if self.is_new(Itime):
+                row = np.nan * np.zeros(self.row_shape)
+            else:
+                row = self.read(Itime, Itime + 1)[0, ...]
+            self.rows[Itime] = row
+        return self.rows[Itime]
+
+    def set(self, Itime, index, values):
+        """ Sets row[index] = values for the row with time index Itime """
+        row = self.get(Itime)
+        row[index] = values
+        self.changed.add(Itime)
+
+    def is_new(self, Itime):
+        """ Is the row missing without having to read the file? """
+        if Itime in self.written:
+            return False
+        return self.ignore_file or Itime >= self.var.shape[0] or (self.num_existing is not None and Itime >= self.num_existing)
+
+    def is_filled(self, Itime, Ilt):
+        """ Do the leadtime indices Ilt have data at any location for time index Itime?
+
+        Returns:
+            np.array: One boolean for each leadtime
+        """
+        Ilt = np.array(Ilt, int)
+        if self.coverage is None or Itime in self.rows:
+            return self.get_row_coverage(self.get(Itime))[Ilt]
+        if self.is_new(Itime):
+            return np.zeros(len(Ilt), bool)
+        if Itime >= self.coverage.shape[0] or (self.coverage[Itime, ...] < 0).any():
+            # Read the row without keeping it, since most checked rows are not changed
+            covered = self.get_row_coverage(self.read(Itime, Itime + 1)[0, ...])
+            self.set_coverage(Itime, Itime + 1, covered)
+            return covered[Ilt]
+        return self.coverage[Itime, ...][Ilt] > 0
+
+    def get_row_coverage(self, row):
+        """ Which slots of a row have data at any location? """
+        return np.isfinite(row).any(axis=self.location_axis)
+
+    def load_coverage(self, stamp):
+        """ Reads the coverage file
+
+        Arguments:
+            stamp (list): get_stamp of the verif file
+
+        Returns:
+            np.array: Coverage, or None if the file is missing, from another version, or
+                older than the last change to the verif file
+        """
+        if not os.path.exists(self.coverage_filename):
+            return None
+        try:
+            with np.load(self.coverage_filename) as cached:
+                if int(cached["version"]) != COVERAGE_VERSION:
+                    return None
+                if list(cached["stamp"]) != list(stamp):
+                    return None
+                coverage = cached["coverage"]
+        except Exception as e:
+            met2verif.util.warning("Could not read coverage file '%s'. %s." % (self.coverage_filename, e))
+            return None
+        if list(coverage.shape) != [self.var.shape[0]] + self.coverage_shape:
+            return None
+        return coverage
+
+    def set_coverage(self, start, end, covered):
+        """ Sets the coverage for time indices start to end (exclusive), adding new times """
+        if end > self.coverage.shape[0]:
+            extra = -np.ones([end - self.coverage.shape[0]] + self.coverage_shape, 'i1')
+            self.coverage = np.concatenate((self.coverage, extra), axis=0)
+        self.coverage[start:end, ...] = covered
+
+    def close(self):
+        """ Saves the coverage file. This must be called after the verif file is closed,
+        such that the coverage file matches the final state of the verif file. """
+        if self.coverage is None:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.coverage_filename))
+        try:
+            fd, temp_filename = tempfile.mkstemp(suffix=".npz", dir=dirname)
+            with os.fdopen(fd, 'wb') as file:
+                np.savez(file, version=COVERAGE_VERSION, stamp=get_stamp(self.verif_filename), coverage=self.coverage)
+            os.replace(temp_filename, self.coverage_filename)
+        except Exception as e:
+            met2verif.util.warning("Could not write coverage file '%s'. %s." % (self.coverage_filename, e))
+
+    def read(self, start, end):
+        """ Reads time indices start to end (exclusive) from the file, with missing values as nan """
+        if self.index is None:
+            values = self.var[start:end, ...]
+        else:
+            values = self.var[start:end, ..., self.index]
+        values = np.ma.filled(values.astype(float), np.nan)
+        values[values == netCDF4.default_fillvals['f4']] = np.nan
+        return values
+
+    def write(self):
+        """ Writes all changed rows to the file, with consecutive times in one operation """
+        Itimes = sorted(self.changed)
+        start = 0
+        while start < len(Itimes):
+            end = start + 1
+            while end < len(Itimes) and Itimes[end] == Itimes[end - 1] + 1:
+                end += 1
+            values = np.array([self.rows[Itime] for Itime in Itimes[start:end]])
+            values[np.isnan(values)] = netCDF4.default_fillvals['f4']
+            if self.index is None:
+                self.var[Itimes[start]:Itimes[end - 1] + 1, ...] = values
+            else:
+                self.var[Itimes[start]:Itimes[end - 1] + 1, ..., self.index] = values
+            if self.coverage is not None:
+                covered = [self.get_row_coverage(self.rows[Itime]) for Itime in Itimes[start:end]]
+                self.set_coverage(Itimes[start], Itimes[end - 1] + 1, covered)
+            start = end
+        self.written.update(self.changed)
+        self.changed.clear()
+
+    def flush(self):
+        """ Writes all changed rows and frees the memory used by the rows. Rows that are used
+        again are read from the file. """
+        self.write()
+        self.rows.clear()
+
+    def clear(self, num_times, chunk_size=100):
+        """ Sets the first num_times times to missing in the file, a few times at a time """
+        for start in range(0, num_times, chunk_size):
+            end = min(start + chunk_size, num_times)
+            values = netCDF4.default_fillvals['f4'] * np.ones([end - start] + self.row_shape)
+            if self.index is None:
+                self.var[start:end, ...] = values
+            else:
+                self.var[start:end, ..., self.index] = values
+            if self.coverage is not None:
+                self.set_coverage(start, end, False)
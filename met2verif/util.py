@@ -1,8 +1,6 @@
-import matplotlib.dates
 import calendar
 import copy
 import datetime
-import matplotlib.pyplot as mpl
 import numpy as np
 import os
 import re
@@ -10,7 +8,7 @@ import sys
 import textwrap
 import netCDF4
 
-import verif.interval
+# matplotlib and verif are slow to import, so they are imported in the functions that use them
 
 """
 There are 4 ways to represent time in verif:
@@ -36,6 +34,7 @@ def date_to_datenum(date):
     Returns:
         int: datenum value
     """
+    import matplotlib.dates
     year = int(date // 10000)
     month = int(date // 100 % 100)
     day = int(date % 100)
@@ -51,6 +50,7 @@ def unixtime_to_datenum(time):
     Returns:
         int: datenum value
     """
+    import matplotlib.dates
     dt = datetime.datetime.utcfromtimestamp(time)
     return matplotlib.dates.date2num(dt)
 
@@ -91,6 +91,7 @@ def datenum_to_date(datenum):
     Returns:
         int: date in YYYYMMDD
     """
+    import matplotlib.dates
     return int(matplotlib.dates.num2date(datenum).strftime("%Y%m%d"))
 
 
@@ -110,6 +111,32 @@ def date_to_unixtime(date):
     return ut
 
 
+def dates_to_unixtime(dates):
+    """ Convert an array of YYYYMMDD to unixtime
+
+    Arguments:
+        dates (np.array): Dates in YYYYMMDD
+
+    Returns:
+        np.array: unixtimes
+
+    Raises:
+        ValueError: If any of the dates are invalid
+    """
+    dates = np.array(dates, int)
+    unique_dates, Iinverse = np.unique(dates, return_inverse=True)
+    year = unique_dates // 10000
+    month = unique_dates // 100 % 100
+    day = unique_dates % 100
+    months = (year - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (month - 1)
+    days_in_month = ((months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")).astype(int)
+    if (month < 1).any() or (month > 12).any() or (day < 1).any() or (day > days_in_month).any():
+        raise ValueError("Invalid date in %s" % unique_dates)
+    days = months.astype("datetime64[D]") + (day - 1)
+    ut = days.astype("datetime64[s]").astype(np.int64)
+    return ut[Iinverse.flatten()].reshape(dates.shape)
+
+
 def date_to_unixtime_slow(date):
     ut = calendar.timegm(datetime.datetime.strptime(str(date), "%Y%m%d").timetuple())
     return ut
@@ -145,6 +172,7 @@ def yellow(text):
 
 
 def remove_margin():
+    import matplotlib.pyplot as mpl
     mpl.subplots_adjust(left=0, right=1, bottom=0, top=1, wspace=0, hspace=0)
 
 
@@ -206,7 +234,7 @@ def parse_numbers(numbers, is_date=False):
             if len(colonList) == 3:
                 step = float(colonList[1])
             if step == 0:
-                verif.util.error("Could not parse '%s': Step cannot be 0." % (numbers))
+                error("Could not parse '%s': Step cannot be 0." % (numbers))
             stepSign = step // abs(step)
             # arange does not include the end point:
             end = float(colonList[-1]) + stepSign * 0.0001
@@ -231,6 +259,7 @@ def parse_numbers(numbers, is_date=False):
 
 def subplot(i, N):
     """ Sets up subplot for index i (starts at 0) out of N """
+    import matplotlib.pyplot as mpl
     [X, Y] = get_subplot_size(N)
     mpl.subplot(Y, X, i + 1)
 
@@ -289,6 +318,7 @@ def fill(x, y_lower, y_upper, col, alpha=1, zorder=0, hatch=''):
             X.append(x[i])
             Y.append(y_upper[i])
     if len(X) > 0:
+        import matplotlib.pyplot as mpl
         mpl.fill(X, Y, facecolor=col, alpha=alpha, linewidth=0, zorder=zorder,
                 hatch=hatch)
 
@@ -410,6 +440,58 @@ def distance(lat1, lon1, lat2, lon2):
     return distance
 
 
+def lat_lon_to_xyz(lats, lons):
+    """
+    Converts latitudes and longitudes to earth-centred cartesian coordinates, on a
+    sphere with the same radius as used by distance(). Values can be vectors.
+
+    Returns:
+        np.array: Array with dimensions (points, 3) in meters
+    """
+    lats = deg2rad(np.array(lats, float))
+    lons = deg2rad(np.array(lons, float))
+    radius = 6.367e6
+    x = radius * np.cos(lats) * np.cos(lons)
+    y = radius * np.cos(lats) * np.sin(lons)
+    z = radius * np.sin(lats)
+    return np.stack([x.flatten(), y.flatten(), z.flatten()], axis=1)
+
+
+def compute_wind_speed(x, y):
+    """ Computes wind speed from x and y wind components """
+    return np.sqrt(x ** 2 + y ** 2)
+
+
+def compute_wind_direction(x, y):
+    """
+    Computes the direction the wind is blowing from, in degrees clockwise from the y-axis.
+    This is relative to north only if the components are. The direction is missing when
+    there is no wind.
+    """
+    direction = np.mod(270 - np.arctan2(y, x) * 180 / np.pi, 360)
+    return np.where((x == 0) & (y == 0), np.nan, direction)
+
+
+def compute_dewpoint(temperature, relative_humidity):
+    """
+    Computes dew point temperature using the Magnus formula
+
+    Arguments:
+        temperature (np.array): Temperature in K
+        relative_humidity (np.array): Relative humidity between 0 and 1
+
+    Returns:
+        np.array: Dew point temperature in K. Missing where relative humidity is not
+            positive.
+    """
+    a = 17.625
+    b = 243.04
+    temperature = temperature - 273.15
+    relative_humidity = np.where(relative_humidity > 0, relative_humidity, np.nan)
+    gamma = np.log(relative_humidity) + a * temperature / (b + temperature)
+    return b * gamma / (a - gamma) + 273.15
+
+
 def apply_threshold(array, bin_type, threshold, upper_threshold=None):
     """ Use bin_type to turn array into binary values """
     if bin_type == "below":
@@ -494,6 +576,7 @@ def get_intervals(bin_type, thresholds):
                         above, above=
     thresholds      numy array of thresholds
     """
+    import verif.interval
     if thresholds is None:
         return [verif.interval.Interval(-np.inf, np.inf, True, True)]
 
@@ -515,7 +598,7 @@ def get_intervals(bin_type, thresholds):
             lower = thresholds[i]
             upper = thresholds[i+1]
         else:
-            verif.util.error("Unrecognized bintype")
+            error("Unrecognized bintype")
         if bin_type in ["below=", "within=", "=within="]:
             upper_eq = True
         if bin_type in ["above=", "=within", "=within="]:
@@ -578,7 +661,7 @@ def proj4_string_to_dict(string):
     for pair in pairs:
         keyvalue = pair.split('=')
         if len(keyvalue) > 2:
-            verif.util.error("Could not parse proj4 parameter: %s" % pair)
+            error("Could not parse proj4 parameter: %s" % pair)
         key = keyvalue[0]
         if len(keyvalue) == 1:
             value = True
@@ -600,10 +683,87 @@ def progress_bar(fraction, width, text=""):
     sys.stdout.flush()
 
 
-def convert_time(time, units):
-    date = netCDF4.num2date(time, units=units)
-    # This somehow doesn't work when the local timezone is not UTC
-    #unixtime = int(date.replace(tzinfo=pytz.UTC).strftime("%s"))
-    unixtime = int((date - datetime.datetime(1970, 1, 1, 0, 0)).total_seconds())
+def convert_time(time, units, calendar="standard"):
+    """ Converts times in CF units (e.g. "hours since 2018-01-01 00:00:00") to unixtime
+
+    For the standard calendar, the units are parsed once and the times converted with numpy
+    arithmetic, rounding to microseconds in the same way as netCDF4.num2date. Other
+    calendars are converted with netCDF4.num2date. Unixtimes are truncated to whole seconds.
+
+    Arguments:
+        time (float or np.array): Time(s) in units
+        units (str): CF time units
+        calendar (str): CF calendar
+
+    Returns:
+        int or np.array: Unixtime(s)
+    """
+    times = np.array(time)
+    if not np.isfinite(times).all():
+        raise ValueError("Cannot convert non-finite times")
+    parsed = parse_time_units(units, calendar)
+    microseconds = None
+    if parsed is not None:
+        factor, offset = parsed
+        if times.dtype.kind == "f":
+            scaled = times.astype(np.longdouble) * factor
+            microseconds = np.array(np.rint(scaled), np.int64)
+            if factor >= 10**6:
+                # Values within a microsecond of a whole second are moved to the second
+                microseconds = np.where(microseconds % 10**6 == 1, np.array(np.floor(scaled), np.int64), microseconds)
+                microseconds = np.where(microseconds % 10**6 == 999999, np.array(np.ceil(scaled), np.int64), microseconds)
+        else:
+            microseconds = times.astype(np.int64) * factor
+        microseconds = microseconds + offset
+        if microseconds.size > 0 and np.min(microseconds) < GREGORIAN_START * 10**6 and calendar != "proleptic_gregorian":
+            microseconds = None
+
+    if microseconds is not None:
+        unixtimes = np.trunc(microseconds / 10**6).astype(int)
+    else:
+        # Dates in other calendars are used as the same date and time in the standard calendar
+        dates = np.array(netCDF4.num2date(times, units=units, calendar=calendar))
+        unixtimes = np.reshape([get_unixtime(date) for date in dates.flatten()], dates.shape).astype(int)
+    if unixtimes.ndim == 0:
+        return int(unixtimes)
+    return unixtimes
+
+
+def get_unixtime(date):
+    """ Returns the unixtime of a datetime object (from any calendar), ignoring microseconds """
+    return calendar.timegm((date.year, date.month, date.day, date.hour, date.minute, date.second))
+
 
-    return unixtime
+# Start of the Gregorian calendar (1582-10-15) in unixtime. The standard calendar is Julian before.
+GREGORIAN_START = -12219292800
+# Microseconds in each time unit
+TIME_UNITS = {"microseconds": 1, "microsecond": 1, "microsecs": 1, "microsec": 1,
+              "milliseconds": 10**3, "millisecond": 10**3, "millisecs": 10**3, "millisec": 10**3, "msecs": 10**3, "msec": 10**3, "ms": 10**3,
+              "seconds": 10**6, "second": 10**6, "secs": 10**6, "sec": 10**6, "s": 10**6,
+              "minutes": 60 * 10**6, "minute": 60 * 10**6, "mins": 60 * 10**6, "min": 60 * 10**6,
+              "hours": 3600 * 10**6, "hour": 3600 * 10**6, "hrs": 3600 * 10**6, "hr": 3600 * 10**6, "h": 3600 * 10**6,
+              "days": 86400 * 10**6, "day": 86400 * 10**6, "d": 86400 * 10**6}
+_time_units_cache = dict()
+
+
+def parse_time_units(units, calendar="standard"):
+    """ Parses CF time units for conversion to unixtime with numpy arithmetic
+
+    Returns:
+        tuple: Microseconds in each unit, and the reference time in microseconds since
+            1970-01-01. None if the units or calendar can only be handled by
+            netCDF4.num2date.
+    """
+    key = (units, calendar)
+    if key not in _time_units_cache:
+        parsed = None
+        words = units.strip().split()
+        if calendar in ["standard", "gregorian", "proleptic_gregorian"] and len(words) > 2 and words[1] == "since" and words[0].lower() in TIME_UNITS:
+            # Let netCDF4 parse the reference time, including the time zone
+            reference = netCDF4.num2date(0, units=units, calendar=calendar, only_use_cftime_datetimes=False)
+            if isinstance(reference, datetime.datetime):
+                delta = reference - datetime.datetime(1970, 1, 1, 0, 0)
+                offset = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+                parsed = (TIME_UNITS[words[0].lower()], offset)
+        _time_units_cache[key] = parsed
+    return _time_units_cache[key]